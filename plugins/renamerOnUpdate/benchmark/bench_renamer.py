@@ -0,0 +1,155 @@
+"""End-to-end benchmark: the plugin against a stand-in Stash (mock_stash.py).
+
+    python benchmark/bench_renamer.py --scenes 2000 --mode both --hooks 50
+
+A synthetic library is built in a temporary folder (files + scratch sqlite),
+the plugin is copied next to it with a config.py using it, then run like Stash
+does: the task renamer ('bulk') and/or one process per updated scene ('hook').
+It reports scenes/sec, GraphQL calls per scene and the time spent in sqlite
+(from the plugin's own timing). The benchmark fails if the plugin logs an error.
+"""
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from mock_stash import MockStash, build_library  # noqa: E402
+
+PLUGIN_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+# kept out of the copy: the user's config and what the plugin saves for itself
+IGNORED = shutil.ignore_patterns(
+    "benchmark", "__pycache__", "config.py", "renamerOnUpdate_*.json*", "*.pickle"
+)
+CONFIG = """
+use_default_template = True
+default_template = "$date $performer - $title [$studio]"
+p_use_default_template = True
+p_default_template = r"{library}/$studio_hierarchy"
+log_file = r"{root}/rename_log.txt"
+timing = True
+timing_dump = r"{root}/timing.json"
+bulk_page_size = {page_size}
+bulk_workers = {workers}
+"""
+
+
+def setup(args, root):
+    library, db_path = build_library(
+        root,
+        scenes=args.scenes,
+        performers=args.performers,
+        studios=args.studios,
+        studio_depth=args.studio_depth,
+    )
+    plugin = path.join(root, "plugin")
+    shutil.copytree(PLUGIN_DIR, plugin, ignore=IGNORED)
+    with open(path.join(PLUGIN_DIR, "renamerOnUpdate_config.py"), encoding="utf8") as f:
+        config = f.read()
+    config += CONFIG.format(
+        library=library,
+        root=root,
+        page_size=args.page_size,
+        workers=args.workers,
+    )
+    with open(path.join(plugin, "config.py"), "w", encoding="utf8") as f:
+        f.write(config)
+    return plugin, db_path
+
+
+def run_plugin(mock, port, plugin, plugin_args):
+    fragment = mock.fragment(port, plugin, plugin_args)
+    process = subprocess.run(
+        [sys.executable, path.join(plugin, "renamerOnUpdate.py")],
+        input=json.dumps(fragment),
+        capture_output=True,
+        text=True,
+        cwd=plugin,
+    )
+    # log.py: \x01 + level + \x02 + message
+    errors = [
+        line
+        for line in process.stderr.splitlines()
+        if line.startswith("\x01e") or (line and not line.startswith("\x01"))
+    ]
+    return errors
+
+
+def sqlite_time(root):
+    try:
+        with open(path.join(root, "timing.json"), encoding="utf8") as f:
+            stages = json.load(f)["stages"]
+    except (OSError, ValueError, KeyError):
+        return 0.0
+    return sum(s["time"] for name, s in stages.items() if name.startswith("sqlite"))
+
+
+def bench(args, mode):
+    root = tempfile.mkdtemp(prefix="renamer_bench_")
+    mock = None
+    try:
+        plugin, db_path = setup(args, root)
+        mock = MockStash(db_path)
+        port = mock.start()
+        errors = []
+        sqlite = 0.0
+        start = time.perf_counter()
+        if mode == "bulk":
+            scenes = args.scenes
+            errors += run_plugin(mock, port, plugin, {"mode": "bulk"})
+            sqlite = sqlite_time(root)
+        else:
+            scenes = min(args.hooks, args.scenes)
+            for scene_id in range(1, scenes + 1):
+                hook = {"type": "Scene.Update.Post", "id": scene_id}
+                errors += run_plugin(mock, port, plugin, {"hookContext": hook})
+                sqlite += sqlite_time(root)
+        elapsed = time.perf_counter() - start
+        calls = sum(mock.calls.values())
+    finally:
+        if mock:
+            mock.stop()
+        if args.keep:
+            print(f"kept {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(
+        f"{mode:>5}: {scenes} scenes in {elapsed:.2f}s ({scenes / elapsed:.1f} scenes/s)"
+        f", {calls / scenes:.2f} GraphQL calls/scene, sqlite {sqlite:.3f}s"
+    )
+    for line in errors[:10]:
+        print(f"       {line.strip()}")
+    return len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=1000)
+    parser.add_argument("--performers", type=int, default=200)
+    parser.add_argument("--studios", type=int, default=20)
+    parser.add_argument("--studio-depth", type=int, default=3)
+    parser.add_argument("--mode", choices=["bulk", "hook", "both"], default="both")
+    parser.add_argument(
+        "--hooks", type=int, default=50, help="number of scenes updated in hook mode"
+    )
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder")
+    args = parser.parse_args()
+
+    modes = ["bulk", "hook"] if args.mode == "both" else [args.mode]
+    errors = sum(bench(args, mode) for mode in modes)
+    if errors:
+        print(f"ERROR: {errors} errors logged by the plugin")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
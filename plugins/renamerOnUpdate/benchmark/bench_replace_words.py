@@ -0,0 +1,99 @@
+"""Micro-benchmark: compiled replace_words stages vs one re.sub per rule.
+
+    python benchmark/bench_replace_words.py --rules 300 --filenames 100000
+
+The results of both are compared, the benchmark fails if they differ.
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import log  # noqa: E402
+import template_engine  # noqa: E402
+
+# the debug lines of the replaced words are not what is measured
+log.LogDebug = lambda s: None
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def synthetic_rules(count, rnd):
+    rules = {}
+    while len(rules) < count:
+        word = "".join(rnd.choice(LETTERS) for _ in range(rnd.randint(4, 9)))
+        kind = rnd.random()
+        if kind < 0.6:
+            rules[word.title()] = word.upper()[:3]
+        elif kind < 0.9:
+            rules[word] = [word[:2].upper(), "any"]
+        else:
+            rules[rf"{word}\d+"] = ["", "regex"]
+    return rules
+
+
+def synthetic_filenames(count, rules, rnd):
+    vocabulary = [w for w in rules if "\\" not in w] + ["Her", "Fantasy", "Ball"]
+    for _ in range(count):
+        words = [rnd.choice(vocabulary) for _ in range(rnd.randint(4, 10))]
+        yield f"2016-12-29 {' '.join(words)} 1080p"
+
+
+def legacy_replace_text(rules, text):
+    for old, new in rules.items():
+        if type(new) is str:
+            new = [new]
+        if len(new) > 1:
+            if new[1] == "regex":
+                tmp = re.sub(old, new[0], text)
+            else:
+                if new[1] == "word":
+                    tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
+                elif new[1] == "any":
+                    tmp = text.replace(old, new[0])
+        else:
+            tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
+        text = tmp
+    return tmp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=300)
+    parser.add_argument("--filenames", type=int, default=100000)
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    rules = synthetic_rules(args.rules, rnd)
+    filenames = list(synthetic_filenames(args.filenames, rules, rnd))
+
+    start = time.perf_counter()
+    legacy_results = [legacy_replace_text(rules, f) for f in filenames]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stages = template_engine.compile_replace_words(rules)
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [template_engine.replace_words(stages, f) for f in filenames]
+    stages_time = time.perf_counter() - start
+    mismatch = sum(1 for a, b in zip(legacy_results, results) if a != b)
+
+    print(f"{len(rules)} rules -> {len(stages)} stages ({compile_time:.3f}s)")
+    for name, elapsed in (("legacy", legacy_time), ("stages", stages_time)):
+        print(
+            f"{name:>7}: {elapsed:.3f}s ({elapsed / len(filenames) * 1e6:.2f}us per filename)"
+        )
+    print(f"speedup: {legacy_time / stages_time:.2f}x")
+    if mismatch:
+        print(f"ERROR: {mismatch} filenames differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Micro-benchmark: compiled templates vs the previous field_replacer pipeline.
+
+    python benchmark/bench_template.py --scenes 100000
+
+Both pipelines render the same synthetic scenes with the same templates, the
+results are compared so the benchmark also checks the compiled templates give
+the same filenames.
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import template_engine  # noqa: E402
+
+TEMPLATES = [
+    "$date $title",
+    "$date $performer - $title [$studio]",
+    "$parent_studio $date $performer - $title",
+    "[$studio] {$date -} $title $height",
+    "$year_$title-$height $video_codec",
+    "$studio_family/$performer_path",
+]
+FIELD_REPLACER = {"$studio": {"replace": "'", "with": ""}}
+WORDS = "sunset beach city night summer party garden morning river forest".split()
+
+
+def synthetic_scenes(count, seed=1):
+    rnd = random.Random(seed)
+    for i in range(count):
+        scene = {
+            "title": " ".join(rnd.choice(WORDS) for _ in range(4)).title(),
+            "height": rnd.choice(["480p", "720p", "1080p", "4k"]),
+            "video_codec": rnd.choice(["H264", "HEVC"]),
+        }
+        if rnd.random() < 0.8:
+            scene["date"] = f"20{rnd.randint(10, 23)}-0{rnd.randint(1, 9)}-1{i % 10}"
+            scene["year"] = scene["date"][0:4]
+        if rnd.random() < 0.7:
+            scene["performer"] = " ".join(
+                f"{rnd.choice(WORDS).title()} P{rnd.randint(1, 500)}"
+                for _ in range(rnd.randint(1, 3))
+            )
+            scene["performer_path"] = scene["performer"]
+        if rnd.random() < 0.9:
+            scene["studio"] = f"Studio's {rnd.randint(1, 300)}"
+            scene["studio_family"] = scene["studio"]
+            if rnd.random() < 0.5:
+                scene["parent_studio"] = f"Network {rnd.randint(1, 20)}"
+                scene["studio_family"] = scene["parent_studio"]
+        yield scene
+
+
+# --- previous implementation, kept here as the baseline -----------------------
+
+
+def legacy_field_replacer(text, scene_information):
+    field_found = re.findall(r"\$\w+", text)
+    result = text
+    title = None
+    if field_found:
+        field_found.sort(key=len, reverse=True)
+    for i in range(0, len(field_found)):
+        f = field_found[i].replace("$", "").strip("_")
+        replaced_word = scene_information.get(f)
+        if not replaced_word:
+            replaced_word = ""
+        if FIELD_REPLACER.get(f"${f}"):
+            replaced_word = replaced_word.replace(
+                FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"]
+            )
+        if f == "title":
+            title = replaced_word.strip()
+            continue
+        if replaced_word == "":
+            result = result.replace(field_found[i], replaced_word)
+        else:
+            result = result.replace(f"${f}", replaced_word)
+    return result, title
+
+
+def legacy_remove_consecutive_nonword(text):
+    for _ in range(0, 10):
+        m = re.findall(r"(\W+)\1+", text)
+        if m:
+            text = re.sub(r"(\W+)\1+", r"\1", text)
+        else:
+            break
+    return text
+
+
+def legacy_cleanup_text(text):
+    text = re.sub(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}", "", text)
+    text = re.sub(r"[{}]", "", text)
+    text = legacy_remove_consecutive_nonword(text)
+    return text.strip(" -_.")
+
+
+def legacy_make(scene, template):
+    r, t = legacy_field_replacer(template, scene)
+    if not t:
+        r = r.replace("$title", "")
+    r = legacy_cleanup_text(r)
+    if t:
+        r = r.replace("$title", t)
+    return r
+
+
+# --- compiled templates --------------------------------------------------------
+
+CACHE = {}
+
+
+def compiled_make(scene, template):
+    if template not in CACHE:
+        CACHE[template] = template_engine.compile_template(
+            template, FIELD_REPLACER, False
+        )
+    r, t = template_engine.render_template(CACHE[template], scene)
+    if not t:
+        r = r.replace("$title", "")
+    r = template_engine.cleanup_text(r)
+    if t:
+        r = r.replace("$title", t)
+    return r
+
+
+def run(make, scenes):
+    start = time.perf_counter()
+    results = [make(scene, template) for scene in scenes for template in TEMPLATES]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=100000)
+    args = parser.parse_args()
+
+    scenes = list(synthetic_scenes(args.scenes))
+    renders = len(scenes) * len(TEMPLATES)
+    legacy_time, legacy_results = run(legacy_make, scenes)
+    compiled_time, compiled_results = run(compiled_make, scenes)
+    mismatch = sum(1 for a, b in zip(legacy_results, compiled_results) if a != b)
+
+    print(f"{len(scenes)} scenes x {len(TEMPLATES)} templates = {renders} renders")
+    for name, elapsed in (("legacy", legacy_time), ("compiled", compiled_time)):
+        print(f"{name:>9}: {elapsed:.3f}s ({elapsed / renders * 1e6:.2f}us per render)")
+    print(f"  speedup: {legacy_time / compiled_time:.2f}x")
+    if mismatch:
+        print(f"ERROR: {mismatch} renders differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
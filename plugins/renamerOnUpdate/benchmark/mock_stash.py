@@ -0,0 +1,532 @@
+"""Stand-in Stash server used by benchmark/bench_renamer.py.
+
+build_library makes a synthetic library: small files on disk and a scratch
+sqlite with the tables of Stash the renamer uses (folders, files, scenes_files,
+video_files...). MockStash answers the GraphQL queries the plugin sends from
+this sqlite, so the renames written by the plugin are seen by the next query
+like with Stash. Only the fields selected by the query are sent back.
+"""
+
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCHEMA = """
+CREATE TABLE galleries (
+    id INTEGER PRIMARY KEY,
+    folder_id INTEGER
+);
+CREATE TABLE folders (
+    id INTEGER PRIMARY KEY,
+    path VARCHAR(255) NOT NULL UNIQUE,
+    parent_folder_id INTEGER,
+    mod_time DATETIME,
+    created_at DATETIME,
+    updated_at DATETIME,
+    zip_file_id INTEGER
+);
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    basename VARCHAR(255) NOT NULL,
+    zip_file_id INTEGER,
+    parent_folder_id INTEGER NOT NULL,
+    size INTEGER,
+    mod_time DATETIME,
+    created_at DATETIME,
+    updated_at DATETIME,
+    UNIQUE (parent_folder_id, basename)
+);
+CREATE TABLE video_files (
+    file_id INTEGER PRIMARY KEY,
+    duration FLOAT,
+    video_codec VARCHAR(255),
+    audio_codec VARCHAR(255),
+    width TINYINT,
+    height TINYINT,
+    frame_rate FLOAT,
+    bit_rate INTEGER
+);
+CREATE TABLE files_fingerprints (
+    file_id INTEGER NOT NULL,
+    type VARCHAR(255) NOT NULL,
+    fingerprint BLOB NOT NULL
+);
+CREATE TABLE studios (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255),
+    parent_id INTEGER
+);
+CREATE TABLE performers (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255),
+    gender VARCHAR(20),
+    favorite BOOLEAN,
+    rating TINYINT
+);
+CREATE TABLE tags (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255)
+);
+CREATE TABLE scenes (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    code TEXT,
+    date DATE,
+    rating TINYINT,
+    organized BOOLEAN,
+    studio_id INTEGER,
+    created_at DATETIME,
+    updated_at DATETIME
+);
+CREATE TABLE scenes_files (
+    scene_id INTEGER,
+    file_id INTEGER,
+    "primary" BOOLEAN,
+    PRIMARY KEY (scene_id, file_id)
+);
+CREATE TABLE performers_scenes (
+    performer_id INTEGER,
+    scene_id INTEGER
+);
+CREATE TABLE scenes_tags (
+    scene_id INTEGER,
+    tag_id INTEGER
+);
+CREATE INDEX index_files_on_parent_folder_id ON files (parent_folder_id);
+CREATE INDEX index_scenes_files_file_id ON scenes_files (file_id);
+"""
+
+WORDS = (
+    "sunset beach city night summer party garden morning river forest "
+    "holiday secret office kitchen dream winter studio session lounge"
+).split()
+
+
+TOKEN_REGEX = re.compile(r"(\w+)\s*:\s*(\w+)(?:\([^)]*\))?|(\w+)(?:\([^)]*\))?|([{}])")
+
+
+def scene_selection(query):
+    """Selection tree of the Scene fragment: {key: subtree or None}."""
+    m = re.search(r"fragment \w+ on Scene \{", query)
+    if not m:
+        return None
+    root = {}
+    stack = [root]
+    last = None
+    for alias, field, name, brace in TOKEN_REGEX.findall(query[m.end() :]):
+        if brace == "{":
+            sub = {}
+            stack[-1][last] = sub
+            stack.append(sub)
+        elif brace == "}":
+            stack.pop()
+            if not stack:
+                break
+        else:
+            last = alias or name
+            stack[-1][last] = None
+    return root
+
+
+def prune(value, tree):
+    if tree is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [prune(v, tree) for v in value]
+    return {k: prune(value.get(k), sub) for k, sub in tree.items() if k in value}
+
+
+def build_library(
+    root, scenes=1000, performers=200, studios=20, studio_depth=3, tags=50, seed=1
+):
+    """Create `root/library` with one small file per scene and `root/stash.sqlite`."""
+    rnd = random.Random(seed)
+    library = os.path.join(root, "library")
+    db_path = os.path.join(root, "stash.sqlite")
+    now = "2024-01-01T00:00:00+00:00"
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+
+    studio_id = 0
+    for _ in range(studios):
+        parent = None
+        for level in range(studio_depth):
+            studio_id += 1
+            db.execute(
+                "INSERT INTO studios VALUES (?, ?, ?)",
+                [studio_id, f"Studio {studio_id} L{level}", parent],
+            )
+            parent = studio_id
+    genders = ["FEMALE", "FEMALE", "MALE", None]
+    for i in range(1, performers + 1):
+        db.execute(
+            "INSERT INTO performers VALUES (?, ?, ?, ?, ?)",
+            [
+                i,
+                f"{rnd.choice(WORDS).title()} Performer{i}",
+                rnd.choice(genders),
+                rnd.random() < 0.2,
+                rnd.choice([None, 20, 60, 100]),
+            ],
+        )
+    for i in range(1, tags + 1):
+        db.execute("INSERT INTO tags VALUES (?, ?)", [i, f"Tag {i}"])
+
+    folder_ids = {}
+
+    def folder(path):
+        if path in folder_ids:
+            return folder_ids[path]
+        parent = os.path.dirname(path)
+        parent_id = folder(parent) if path != library else None
+        os.makedirs(path, exist_ok=True)
+        cursor = db.execute(
+            "INSERT INTO folders (path, parent_folder_id, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [path, parent_id, now, now, now],
+        )
+        folder_ids[path] = cursor.lastrowid
+        return folder_ids[path]
+
+    folder(library)
+    for i in range(1, scenes + 1):
+        directory = os.path.join(library, f"batch{i % 20:02d}")
+        basename = f"scene_{i:07d}.mp4"
+        folder_id = folder(directory)
+        with open(os.path.join(directory, basename), "wb") as f:
+            f.write(b"\0" * 16)
+        cursor = db.execute(
+            "INSERT INTO files (basename, parent_folder_id, size, mod_time, created_at, updated_at) VALUES (?, ?, 16, ?, ?, ?)",
+            [basename, folder_id, now, now, now],
+        )
+        file_id = cursor.lastrowid
+        height = rnd.choice([480, 720, 1080, 2160])
+        db.execute(
+            "INSERT INTO video_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                file_id,
+                rnd.uniform(60, 3600),
+                "h264",
+                "aac",
+                height * 16 // 9,
+                height,
+                29.97,
+                rnd.randint(1000000, 9000000),
+            ],
+        )
+        db.execute(
+            "INSERT INTO files_fingerprints VALUES (?, 'oshash', ?)",
+            [file_id, f"{rnd.getrandbits(64):016x}"],
+        )
+        db.execute(
+            "INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                i,
+                " ".join(rnd.choice(WORDS) for _ in range(4)).title(),
+                f"CODE-{i}",
+                f"20{rnd.randint(10, 23)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+                rnd.choice([None, 40, 80]),
+                rnd.random() < 0.8,
+                rnd.randint(1, studio_id) if studio_id else None,
+                now,
+                now,
+            ],
+        )
+        db.execute("INSERT INTO scenes_files VALUES (?, ?, 1)", [i, file_id])
+        for p in rnd.sample(range(1, performers + 1), rnd.randint(0, 3)):
+            db.execute("INSERT INTO performers_scenes VALUES (?, ?)", [p, i])
+        for t in rnd.sample(range(1, tags + 1), min(tags, rnd.randint(0, 6))):
+            db.execute("INSERT INTO scenes_tags VALUES (?, ?)", [i, t])
+    db.commit()
+    db.close()
+    return library, db_path
+
+
+class MockStash:
+    """Answer the renamer's GraphQL queries from the scratch sqlite."""
+
+    def __init__(self, db_path, schema_version=60):
+        self.db_path = db_path
+        self.schema_version = schema_version
+        self.calls = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    # --- data access ---------------------------------------------------------
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _studio(self, db, studio_id, with_parent=True):
+        row = db.execute(
+            "SELECT id, name, parent_id FROM studios WHERE id=?", [studio_id]
+        ).fetchone()
+        if row is None:
+            return None
+        studio = {"id": str(row["id"]), "name": row["name"]}
+        if with_parent:
+            studio["parent_studio"] = (
+                self._studio(db, row["parent_id"], False) if row["parent_id"] else None
+            )
+        return studio
+
+    def _scene(self, db, row):
+        scene_id = row["id"]
+        files = []
+        for f in db.execute(
+            """
+            SELECT files.id, folders.path || ? || files.basename AS path, video_files.*
+            FROM scenes_files
+            JOIN files ON files.id = scenes_files.file_id
+            JOIN folders ON folders.id = files.parent_folder_id
+            JOIN video_files ON video_files.file_id = files.id
+            WHERE scenes_files.scene_id = ?
+            ORDER BY scenes_files."primary" DESC, files.id
+            """,
+            [os.sep, scene_id],
+        ):
+            fingerprints = [
+                {"type": fp["type"], "value": fp["fingerprint"]}
+                for fp in db.execute(
+                    "SELECT type, fingerprint FROM files_fingerprints WHERE file_id=?",
+                    [f["id"]],
+                )
+            ]
+            oshash = next(
+                (x["value"] for x in fingerprints if x["type"] == "oshash"), None
+            )
+            files.append(
+                {
+                    "id": str(f["id"]),
+                    "path": f["path"],
+                    "video_codec": f["video_codec"],
+                    "audio_codec": f["audio_codec"],
+                    "width": f["width"],
+                    "height": f["height"],
+                    "frame_rate": f["frame_rate"],
+                    "duration": f["duration"],
+                    "bit_rate": f["bit_rate"],
+                    "phash": None,
+                    "oshash": oshash,
+                    "checksum": None,
+                    "fingerprints": fingerprints,
+                }
+            )
+        performers = [
+            {
+                "id": str(p["id"]),
+                "name": p["name"],
+                "gender": p["gender"],
+                "favorite": bool(p["favorite"]),
+                "rating100": p["rating"],
+                "stash_ids": [],
+            }
+            for p in db.execute(
+                """
+                SELECT performers.* FROM performers_scenes
+                JOIN performers ON performers.id = performers_scenes.performer_id
+                WHERE performers_scenes.scene_id = ?
+                """,
+                [scene_id],
+            )
+        ]
+        tags = [
+            {"id": str(t["id"]), "name": t["name"]}
+            for t in db.execute(
+                """
+                SELECT tags.* FROM scenes_tags
+                JOIN tags ON tags.id = scenes_tags.tag_id
+                WHERE scenes_tags.scene_id = ?
+                """,
+                [scene_id],
+            )
+        ]
+        return {
+            "id": str(scene_id),
+            "title": row["title"],
+            "code": row["code"],
+            "date": row["date"],
+            "rating100": row["rating"],
+            "organized": bool(row["organized"]),
+            "updated_at": row["updated_at"],
+            "stash_ids": [],
+            "files": files,
+            "studio": self._studio(db, row["studio_id"]) if row["studio_id"] else None,
+            "tags": tags,
+            "performers": performers,
+            "movies": [],
+        }
+
+    def _find_scenes(self, db, variables):
+        find_filter = variables.get("filter") or {}
+        scene_filter = variables.get("scene_filter") or {}
+        where, args = [], []
+        for field, criterion in scene_filter.items():
+            modifier = criterion["modifier"]
+            value = criterion["value"]
+            if field == "id":
+                column = "scenes.id"
+            elif field == "updated_at":
+                column = "scenes.updated_at"
+            elif field == "path":
+                column = "(SELECT folders.path || ? || files.basename FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id WHERE scenes_files.scene_id = scenes.id)"
+                args.append(os.sep)
+            else:
+                raise ValueError(f"unsupported scene_filter {field}")
+            operator = {"EQUALS": "=", "GREATER_THAN": ">", "LESS_THAN": "<"}[modifier]
+            where.append(f"{column} {operator} ?")
+            args.append(value)
+        sql_where = f"WHERE {' AND '.join(where)}" if where else ""
+        count = db.execute(f"SELECT COUNT(*) FROM scenes {sql_where}", args).fetchone()[
+            0
+        ]
+        sort = find_filter.get("sort", "id")
+        if sort not in ("id", "updated_at", "title"):
+            sort = "id"
+        direction = "DESC" if find_filter.get("direction") == "DESC" else "ASC"
+        per_page = find_filter.get("per_page", 25)
+        page = find_filter.get("page", 1)
+        limit = ""
+        if per_page >= 0:
+            limit = f"LIMIT {int(per_page)} OFFSET {int((page - 1) * per_page)}"
+        rows = db.execute(
+            f"SELECT * FROM scenes {sql_where} ORDER BY scenes.{sort} {direction}, scenes.id {direction} {limit}",
+            args,
+        ).fetchall()
+        return {"count": count, "scenes": [self._scene(db, row) for row in rows]}
+
+    def _find_studios(self, db, variables):
+        find_filter = variables.get("filter") or {}
+        per_page = find_filter.get("per_page", 25)
+        page = find_filter.get("page", 1)
+        count = db.execute("SELECT COUNT(*) FROM studios").fetchone()[0]
+        limit = ""
+        if per_page >= 0:
+            limit = f"LIMIT {int(per_page)} OFFSET {int((page - 1) * per_page)}"
+        rows = db.execute(f"SELECT id FROM studios ORDER BY id {limit}").fetchall()
+        return {"count": count, "studios": [self._studio(db, r["id"]) for r in rows]}
+
+    def _bulk_scene_update(self, db, variables):
+        update = variables["input"]
+        ids = [int(i) for i in update["ids"]]
+        tag_ids = [int(i) for i in update.get("tag_ids", {}).get("ids", [])]
+        now = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
+        for scene_id in ids:
+            for tag_id in tag_ids:
+                db.execute(
+                    "DELETE FROM scenes_tags WHERE scene_id=? AND tag_id=?",
+                    [scene_id, tag_id],
+                )
+            db.execute("UPDATE scenes SET updated_at=? WHERE id=?", [now, scene_id])
+        db.commit()
+        return [{"id": str(i)} for i in ids]
+
+    def execute(self, query, variables):
+        variables = variables or {}
+        selection = scene_selection(query)
+        db = self._connect()
+        try:
+            if "bulkSceneUpdate" in query:
+                name = "bulkSceneUpdate"
+                data = {name: self._bulk_scene_update(db, variables)}
+            elif "findScenes" in query:
+                name = "findScenes"
+                data = {name: self._find_scenes(db, variables)}
+                if selection:
+                    data[name]["scenes"] = [
+                        prune(x, selection) for x in data[name]["scenes"]
+                    ]
+            elif "findScene(" in query:
+                name = "findScene"
+                row = db.execute(
+                    "SELECT * FROM scenes WHERE id=?", [int(variables["id"])]
+                ).fetchone()
+                data = {name: self._scene(db, row) if row else None}
+                if selection and data[name]:
+                    data[name] = prune(data[name], selection)
+            elif "findStudios" in query:
+                name = "findStudios"
+                data = {name: self._find_studios(db, variables)}
+            elif "findStudio(" in query:
+                name = "findStudio"
+                data = {name: self._studio(db, int(variables["id"]))}
+            elif "configuration" in query:
+                name = "configuration"
+                library = os.path.join(os.path.dirname(self.db_path), "library")
+                data = {
+                    name: {
+                        "general": {
+                            "databasePath": self.db_path,
+                            "stashes": [{"path": library}],
+                        }
+                    }
+                }
+            elif "systemStatus" in query:
+                name = "systemStatus"
+                data = {name: {"databaseSchema": self.schema_version}}
+            else:
+                raise ValueError(f"unsupported query: {query[:80]}")
+        finally:
+            db.close()
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        return data
+
+    # --- http ----------------------------------------------------------------
+
+    def start(self, port=0):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                request = json.loads(body)
+                try:
+                    payload = {
+                        "data": mock.execute(request["query"], request.get("variables"))
+                    }
+                except Exception as err:
+                    payload = {"errors": [{"message": str(err)}]}
+                raw = json.dumps(payload).encode()
+                with mock._lock:
+                    mock.bytes_sent += len(raw)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def fragment(self, port, plugin_dir, args):
+        return {
+            "server_connection": {
+                "Scheme": "http",
+                "Host": "127.0.0.1",
+                "Port": port,
+                "SessionCookie": {"Value": "benchmark"},
+                "PluginDir": plugin_dir,
+            },
+            "args": args,
+        }
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import log
+import timing
+
+# Database layer used by the task renamer.
+# RenameBatch (file refactor database): the folders are loaded once, the file of
+# a scene is found with one query and the renames are grouped in a transaction,
+# committed every `batch_size` files or `max_age` seconds. Stash can't write while
+# it's open, so it's also committed before a move copying the file. Every rename
+# has its own savepoint so a failing one can be undone alone.
+# PathIndex: the paths already used, to check duplicates without asking Stash.
+
+
+class RenameBatch:
+    def __init__(
+        self, conn: sqlite3.Connection, batch_size=100, wal=False, max_age=1.0
+    ):
+        self.conn = conn
+        self.batch_size = max(1, batch_size)
+        self.max_age = max_age
+        self.pending = 0
+        self.started = 0.0
+        if wal:
+            mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            log.LogDebug(f"[SQLITE] journal mode: {mode}")
+        self.folders = dict(conn.execute("SELECT path, id FROM folders"))
+        log.LogDebug(f"[SQLITE] {len(self.folders)} folders loaded")
+
+    def get_folder_id(self, path: str):
+        folder_id = self.folders.get(path)
+        if folder_id is None:
+            # Stash could have added it since the folders were loaded
+            row = self.conn.execute(
+                "SELECT id FROM folders WHERE path=?", [path]
+            ).fetchone()
+            if row:
+                folder_id = self.folders[path] = row[0]
+        return folder_id
+
+    def create_folder(self, path: str, mod_time: str):
+        """Add the folder under the closest parent known by Stash, None if there is none."""
+        parent = path
+        for _ in range(1, len(path.split(os.sep))):
+            parent = os.path.dirname(parent)
+            parent_id = self.get_folder_id(parent)
+            if parent_id:
+                cursor = self.conn.execute(
+                    "INSERT INTO 'main'.'folders'('path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?);",
+                    [path, parent_id, mod_time, mod_time, mod_time, None],
+                )
+                self.folders[path] = cursor.lastrowid
+                return cursor.lastrowid
+        return None
+
+    def get_file_id(self, scene_id, folder_id):
+        # it can have multiple file for a scene, the one in the old folder is ours.
+        row = self.conn.execute(
+            "SELECT files.id FROM scenes_files JOIN files ON files.id = scenes_files.file_id WHERE scenes_files.scene_id=? AND files.parent_folder_id=?",
+            [scene_id, folder_id],
+        ).fetchone()
+        return row[0] if row else None
+
+    @timing.timed("sqlite rename")
+    def rename_file(self, scene_info: dict):
+        # 2022-09-17T11:25:52+02:00
+        mod_time = datetime.now().astimezone().isoformat("T", "seconds")
+        self.begin()
+        self.conn.execute("SAVEPOINT rename_file")
+        created = []
+        try:
+            folder_id = self.get_folder_id(scene_info["new_directory"])
+            if not folder_id:
+                folder_id = self.create_folder(scene_info["new_directory"], mod_time)
+                if not folder_id:
+                    raise Exception(
+                        f"You need to setup a library with the new location ({scene_info['new_directory']}) and scan at least 1 file"
+                    )
+                created.append(scene_info["new_directory"])
+            file_id = scene_info.get("file_id")
+            if not file_id:
+                file_id = self.get_file_id(
+                    scene_info["scene_id"],
+                    self.get_folder_id(scene_info["current_directory"]),
+                )
+            if not file_id:
+                raise Exception("Failed to find file_id")
+            self.conn.execute(
+                "UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;",
+                [scene_info["new_filename"], folder_id, mod_time, file_id],
+            )
+        except Exception:
+            self.conn.execute("ROLLBACK TO rename_file")
+            self.conn.execute("RELEASE rename_file")
+            for path in created:
+                del self.folders[path]
+            raise
+        self.conn.execute("RELEASE rename_file")
+        self.pending += 1
+        self.release()
+
+    @timing.timed("sqlite folder")
+    def remove_folder(self, path: str):
+        """Forget a removed folder, unless something in the database still uses it."""
+        folder_id = self.get_folder_id(path)
+        if folder_id is None:
+            return
+        self.begin()
+        cursor = self.conn.execute(
+            "DELETE FROM folders WHERE id=? AND NOT EXISTS (SELECT 1 FROM files WHERE parent_folder_id=?) AND NOT EXISTS (SELECT 1 FROM folders WHERE parent_folder_id=?) AND NOT EXISTS (SELECT 1 FROM galleries WHERE folder_id=?)",
+            [folder_id, folder_id, folder_id, folder_id],
+        )
+        if cursor.rowcount:
+            del self.folders[path]
+
+    def begin(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+            self.started = time.monotonic()
+
+    def release(self, slow=False):
+        """Commit if the batch is full or old, or before a `slow` operation."""
+        if not self.conn.in_transaction:
+            return
+        if (
+            slow
+            or self.pending >= self.batch_size
+            or time.monotonic() - self.started >= self.max_age
+        ):
+            self.commit()
+
+    @timing.timed("sqlite commit")
+    def commit(self):
+        if self.conn.in_transaction:
+            self.conn.commit()
+            log.LogDebug(f"[SQLITE] {self.pending} renames committed")
+        self.pending = 0
+
+
+class PathIndex:
+    """Every file path known by Stash and the scenes using it."""
+
+    def __init__(self):
+        self.paths = None
+        self.basenames = {}
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.paths is not None
+
+    @timing.timed("sqlite path index")
+    def load(self, conn: sqlite3.Connection, file_refactor=True):
+        self.paths = {}
+        self.basenames = {}
+        if file_refactor:
+            rows = conn.execute(
+                "SELECT folders.path, files.basename, scenes_files.scene_id FROM files JOIN folders ON folders.id = files.parent_folder_id LEFT JOIN scenes_files ON scenes_files.file_id = files.id"
+            )
+            for folder, basename, scene_id in rows:
+                self.add(os.path.join(folder, basename), scene_id)
+        else:
+            for scene_id, path in conn.execute("SELECT id, path FROM scenes"):
+                self.add(path, scene_id)
+        log.LogDebug(f"[SQLITE] {len(self.paths)} paths loaded")
+
+    def add(self, path: str, scene_id=None):
+        scenes = self.paths.setdefault(path, set())
+        if scene_id is not None:
+            scenes.add(str(scene_id))
+        self.basenames.setdefault(os.path.basename(path), set()).add(path)
+
+    def reserve(self, old_path: str, new_path: str):
+        """Take the new path for the scenes of the old one. The old path stays used until it's released."""
+        with self.lock:
+            scenes = self.paths.get(old_path, set())
+            self.add(new_path)
+            self.paths[new_path].update(scenes)
+
+    def release(self, path: str):
+        with self.lock:
+            self.paths.pop(path, None)
+            same_name = self.basenames.get(os.path.basename(path))
+            if same_name:
+                same_name.discard(path)
+
+    def scenes_with_path(self, path: str):
+        """None if there is no file with this path."""
+        with self.lock:
+            scenes = self.paths.get(path)
+            return None if scenes is None else set(scenes)
+
+    def scenes_with_basename(self, basename: str):
+        scenes = set()
+        with self.lock:
+            for path in self.basenames.get(basename, ()):
+                scenes.update(self.paths[path])
+        return scenes
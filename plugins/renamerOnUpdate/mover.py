@@ -0,0 +1,145 @@
+import errno
+import hashlib
+import os
+import shutil
+import sys
+
+import log
+
+# Moving a file on the same filesystem is a rename. Across filesystems the file
+# is copied by chunks next to its destination, checked, then renamed in place:
+# the source is only deleted once the copy is complete.
+
+CHUNK_SIZE = 64 * 1024 * 1024
+# sendfile only writes to a regular file on Linux
+KERNEL_COPY = [
+    method
+    for method in ("copy_file_range", "sendfile")
+    if hasattr(os, method) and sys.platform.startswith("linux")
+]
+
+
+def move_file(src: str, dst: str, progress=None, verify_hash=False):
+    """Move `src` to `dst`. `progress` is called with the copied fraction when a copy is needed."""
+    if same_device(src, dst):
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as err:
+            # bind mount, overlay... the kernel still refuses the rename
+            if err.errno != errno.EXDEV:
+                raise
+    copy_and_delete(src, dst, progress, verify_hash)
+
+
+def same_device(src: str, dst: str):
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(dst) or ".").st_dev
+    except OSError:
+        return False
+
+
+def device(path: str):
+    """st_dev of the path, or of its closest existing parent."""
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def copy_and_delete(src: str, dst: str, progress=None, verify_hash=False):
+    size = os.path.getsize(src)
+    tmp = f"{dst}.part"
+    log.LogDebug(f"[OS] Copying to another filesystem ({size} bytes)")
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            if verify_hash:
+                src_hash = copy_read_write(fsrc, fdst, size, progress)
+            else:
+                copy_fd(fsrc, fdst, size, progress)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            copied = os.fstat(fdst.fileno()).st_size
+        if copied != size:
+            raise OSError(f"Copy is incomplete ({copied}/{size} bytes)")
+        if verify_hash and file_hash(tmp) != src_hash:
+            raise OSError("Copy is different from the original file (hash)")
+        # keep the modification time, Stash uses it to detect a changed file.
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    try:
+        os.unlink(src)
+    except OSError:
+        # the original is still there (used by another process?), undo the copy.
+        os.remove(dst)
+        raise
+
+
+def copy_fd(fsrc, fdst, size: int, progress=None):
+    """Copy in the kernel when possible (copy_file_range, sendfile)."""
+    for method in KERNEL_COPY:
+        try:
+            copy_kernel(method, fsrc.fileno(), fdst.fileno(), size, progress)
+            return
+        except OSError as err:
+            # not supported for these files, try the next method from the start
+            if err.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.ENOTSUP,
+            ):
+                raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    copy_read_write(fsrc, fdst, size, progress)
+
+
+def copy_kernel(method: str, fd_src: int, fd_dst: int, size: int, progress=None):
+    copied = 0
+    while True:
+        if method == "copy_file_range":
+            sent = os.copy_file_range(fd_src, fd_dst, CHUNK_SIZE)
+        else:
+            sent = os.sendfile(fd_dst, fd_src, copied, CHUNK_SIZE)
+        if sent == 0:
+            break
+        copied += sent
+        if progress and size:
+            progress(copied / size)
+
+
+def copy_read_write(fsrc, fdst, size: int, progress=None):
+    """Copy through Python, returns the hash of the data."""
+    h = hashlib.md5()
+    copied = 0
+    while True:
+        chunk = fsrc.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+        fdst.write(chunk)
+        copied += len(chunk)
+        if progress and size:
+            progress(copied / size)
+    return h.hexdigest()
+
+
+def file_hash(path: str):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
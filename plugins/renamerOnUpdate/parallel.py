@@ -0,0 +1,58 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+
+# Used by the task renamer to overlap the moves on different drives.
+# The moves are grouped by (source device, destination device): a group runs
+# its moves one after the other, up to `workers` groups run at the same time.
+# Everything given to `write` runs in a single thread, so the database is
+# still written by one connection, in order.
+
+
+class RenameExecutor:
+    def __init__(self, workers: int):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.groups = {}
+        self.running = set()
+        self.lock = threading.Condition()
+
+    def submit(self, group, function, *args):
+        with self.lock:
+            jobs = self.groups.setdefault(group, collections.deque())
+            jobs.append((function, args))
+            if group in self.running:
+                return
+            self.running.add(group)
+        self.pool.submit(self._run_group, group)
+
+    def _run_group(self, group):
+        while True:
+            with self.lock:
+                jobs = self.groups[group]
+                if not jobs:
+                    self.running.discard(group)
+                    self.lock.notify_all()
+                    return
+                function, args = jobs.popleft()
+            try:
+                function(*args)
+            except Exception as err:
+                log.LogError(f"Error during the rename ({err})")
+
+    def write(self, function, *args):
+        """Run `function` in the database thread and wait for its result."""
+        return self.writer.submit(function, *args).result()
+
+    def wait(self):
+        """Wait until every submitted move is done."""
+        with self.lock:
+            while self.running:
+                self.lock.wait()
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+        self.writer.shutdown()
@@ -1,15 +1,86 @@
+import collections
 import difflib
+import errno
+import fnmatch
+import functools
+import heapq
 import json
 import os
 import re
-import shutil
+import secrets
 import sqlite3
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import database
+import log
+import mover
+import parallel
+import state
+import template_engine
+import timing
+import worker
+
+try:
+    import config
+except Exception:
+    log.LogWarning("Could not import ROU config file, did you rename the template file to 'config.py'? Defaulting to template config file")
+    import renamerOnUpdate_config as config
+import renamerOnUpdate_config as config_template
+
+
+def config_option(name: str):
+    """An option of config.py, the template's value if config.py was copied before it existed."""
+    return getattr(config, name, getattr(config_template, name))
+
+
+START_TIME = time.time()
+if config_option("timing"):
+    timing.enable(config_option("timing_dump").endswith(".prof"))
+FRAGMENT = json.loads(sys.stdin.read())
+
+FRAGMENT_SERVER = FRAGMENT["server_connection"]
+PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
+
+# set by the tasks, they take precedence over config.py
+STATE = state.StateStore(os.path.join(PLUGIN_DIR, "renamerOnUpdate_state.json"))
+HOOK_ENABLED = STATE.get("enable_hook", config.enable_hook)
+
+
+PLUGIN_ARGS = FRAGMENT["args"].get("mode")
+
+# Hand the scene to the worker before loading anything else, that's what it is for.
+if not PLUGIN_ARGS and HOOK_ENABLED and config_option("hook_worker"):
+    worker_result = worker.send(
+        config_option("hook_worker_port"),
+        {
+            "scene_id": FRAGMENT["args"]["hookContext"]["id"],
+            "server_connection": FRAGMENT_SERVER,
+            "token": STATE.get("worker_token"),
+        },
+    )
+    if worker_result:
+        print(
+            json.dumps(
+                {"output": worker_result["output"], "error": worker_result["error"]}
+            )
+        )
+        sys.exit()
+    # the scene is renamed here, and if no worker is running one is started for
+    # the next hooks (not when it's only busy).
+    if worker_result is None:
+        worker.spawn(
+            os.path.abspath(__file__),
+            {"server_connection": FRAGMENT_SERVER, "args": {"mode": "worker"}},
+        )
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import psutil  # pip install psutil
@@ -25,19 +96,24 @@ try:
 except Exception:
     MODULE_UNIDECODE = False
 
-import log
-
-try:
-    import config
-except Exception:
-    log.LogWarning("Could not import ROU config file, did you rename the template file to 'config.py'? Defaulting to template config file")
-    import renamerOnUpdate_config as config
-
 
 DB_VERSION_FILE_REFACTOR = 32
 DB_VERSION_SCENE_STUDIO_CODE = 38
 
-DRY_RUN = config.dry_run
+CONFIG_CACHE = None
+GRAPHQL_STATS = {"count": 0, "time": 0.0}
+GRAPHQL_STATS_LOCK = threading.Lock()
+# the operation name, or the first field for an unnamed one ({ systemStatus {...} })
+GRAPHQL_NAME_REGEX = re.compile(r"(?:query|mutation)\s+(\w+)|{\s*(\w+)")
+
+TITLECASE_WORD_REGEX = re.compile(r"\b[A-Z]?[a-z\'\u2019\u2018]+\b")
+# not capitalized between other words
+TITLECASE_EXCEPTIONS = frozenset({"and", "of", "the"})
+NON_ASCII_REGEX = re.compile(r"[^\x00-\x7f]+")
+ILLEGAL_CHARACTER_REGEX = re.compile('[\\/:"*?<>|]+')
+APOSTROPHE_REGEX = re.compile("[’‘”“]+")
+
+DRY_RUN = STATE.get("dry_run", config.dry_run)
 DRY_RUN_FILE = None
 
 if config.log_file:
@@ -51,49 +127,74 @@ if DRY_RUN:
             os.remove(DRY_RUN_FILE)
     log.LogInfo("Dry mode on")
 
-START_TIME = time.time()
-FRAGMENT = json.loads(sys.stdin.read())
-
-FRAGMENT_SERVER = FRAGMENT["server_connection"]
-PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
-
+# log.LogDebug("{}".format(FRAGMENT))
 
-PLUGIN_ARGS = FRAGMENT["args"].get("mode")
 
-# log.LogDebug("{}".format(FRAGMENT))
+def create_graphql_session():
+    # One session for the whole run, the connections are kept alive and reused.
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Accept-Encoding": "gzip, deflate, br",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+            "DNT": "1",
+        }
+    )
+    # the queries/mutations sent can be replayed safely, so POST is retried too.
+    retry = Retry(
+        total=config_option("graphql_retries"),
+        backoff_factor=config_option("graphql_backoff"),
+        status_forcelist=[502, 503, 504],
+        allowed_methods=None,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config_option("graphql_pool_size"),
+        max_retries=retry,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
-def callGraphQL(query, variables=None):
-    # Session cookie for authentication
+def get_graphql_url():
     graphql_port = str(FRAGMENT_SERVER["Port"])
     graphql_scheme = FRAGMENT_SERVER["Scheme"]
-    graphql_cookies = {"session": FRAGMENT_SERVER["SessionCookie"]["Value"]}
-    graphql_headers = {
-        "Accept-Encoding": "gzip, deflate, br",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Connection": "keep-alive",
-        "DNT": "1",
-    }
     graphql_domain = FRAGMENT_SERVER["Host"]
     if graphql_domain == "0.0.0.0":
         graphql_domain = "localhost"
     # Stash GraphQL endpoint
-    graphql_url = f"{graphql_scheme}://{graphql_domain}:{graphql_port}/graphql"
+    return f"{graphql_scheme}://{graphql_domain}:{graphql_port}/graphql"
+
+
+def callGraphQL(query, variables=None):
+    # Session cookie for authentication
+    graphql_cookies = {"session": FRAGMENT_SERVER["SessionCookie"]["Value"]}
 
     json = {"query": query}
     if variables is not None:
         json["variables"] = variables
+    request_start = time.perf_counter()
     try:
-        response = requests.post(
-            graphql_url,
+        response = GRAPHQL_SESSION.post(
+            GRAPHQL_URL,
             json=json,
-            headers=graphql_headers,
             cookies=graphql_cookies,
-            timeout=20,
+            timeout=config_option("graphql_timeout"),
         )
     except Exception as e:
         exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
+    finally:
+        request_time = time.perf_counter() - request_start
+        with GRAPHQL_STATS_LOCK:
+            GRAPHQL_STATS["count"] += 1
+            GRAPHQL_STATS["time"] += request_time
+        if timing.ENABLED:
+            name = GRAPHQL_NAME_REGEX.search(query)
+            name = name.group(1) or name.group(2) if name else "?"
+            timing.add(f"graphql {name}", request_time)
     if response.status_code == 200:
         result = response.json()
         if result.get("error"):
@@ -110,6 +211,74 @@ def callGraphQL(query, variables=None):
         )
 
 
+def scene_fields() -> str:
+    """Selection of a scene, with only what the templates and options use."""
+    templates = [PATH_NON_ORGANIZED]
+    for templates_dict in (
+        config.tag_templates,
+        config.studio_templates,
+        config.p_tag_templates,
+        config.p_studio_templates,
+        config.p_path_templates,
+    ):
+        templates.extend(templates_dict.values())
+    if config.use_default_template:
+        templates.append(config.default_template)
+    if config.p_use_default_template:
+        templates.append(config.p_default_template)
+    # $year_$title: the field is $year
+    fields = {
+        "$" + field[1:].strip("_")
+        for field in template_engine.FIELD_REGEX.findall(" ".join(templates))
+    }
+
+    query = ["id", "title", "organized"]
+    if PLUGIN_ARGS == "incremental":
+        query.append("updated_at")
+    if fields & {"$date", "$date_format", "$year"}:
+        query.append("date")
+    if "$rating" in fields:
+        query.append("rating100")
+    if "$stashid_scene" in fields:
+        query.append("stash_ids { endpoint stash_id }")
+    if "$studio_code" in fields and DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
+        query.append("code")
+    # extract_info always needs these
+    file_fields = "video_codec audio_codec width height duration"
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        file_fields = f"id path {file_fields} bit_rate"
+        if fields & {"$oshash", "$checksum"} or LOGFILE:
+            file_fields += """
+                oshash: fingerprint(type: "oshash")
+                checksum: fingerprint(type: "checksum")
+                fingerprints { type value }"""
+        query.append(f"files {{ {file_fields} }}")
+    else:
+        query.append(f"path file {{ {file_fields} framerate bitrate }}")
+    if (
+        fields & {"$studio", "$parent_studio", "$studio_family", "$studio_hierarchy"}
+        or config.studio_templates
+        or config.p_studio_templates
+    ):
+        query.append("studio { id name parent_studio { id name } }")
+    if (
+        "$tags" in fields
+        or config.tag_templates
+        or config.p_tag_templates
+        or config.p_tag_option
+    ):
+        query.append("tags { id name }")
+    if fields & {"$performer", "$stashid_performer"}:
+        performer = ["id", "name", "gender", "favorite", "rating100"]
+        if "$stashid_performer" in fields:
+            performer.append("stash_ids { endpoint stash_id }")
+        query.append(f"performers {{ {' '.join(performer)} }}")
+    if fields & {"$movie_scene", "$movie_title", "$movie_year"}:
+        query.append("movies { movie { name date } scene_index }")
+    log.LogDebug(f"Scene fields used: {query}")
+    return "\n        ".join([""] + query)
+
+
 def graphql_getScene(scene_id):
     query = (
         """
@@ -118,48 +287,9 @@ def graphql_getScene(scene_id):
             ...SceneData
         }
     }
-    fragment SceneData on Scene {
-        id
-        title
-        date
-        rating100
-        stash_ids {
-            endpoint
-            stash_id
-        }
-        organized"""
-        + FILE_QUERY
+    fragment SceneData on Scene {"""
+        + SCENE_FIELDS
         + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating100
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
     }
     """
     )
@@ -169,60 +299,22 @@ def graphql_getScene(scene_id):
 
 
 # used for bulk
-def graphql_findScene(perPage, direc="DESC") -> dict:
+def graphql_findScene(
+    perPage, direc="DESC", page=1, sort="updated_at", scene_filter=None
+) -> dict:
     query = (
         """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+        findScenes(filter: $filter, scene_filter: $scene_filter) {
             count
             scenes {
                 ...SlimSceneData
             }
         }
     }
-    fragment SlimSceneData on Scene {
-        id
-        title
-        date
-        rating100
-        organized
-        stash_ids {
-            endpoint
-            stash_id
-        }
-    """
-        + FILE_QUERY
+    fragment SlimSceneData on Scene {"""
+        + SCENE_FIELDS
         + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating100
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
     }
     """
     )
@@ -230,15 +322,81 @@ def graphql_findScene(perPage, direc="DESC") -> dict:
     variables = {
         "filter": {
             "direction": direc,
-            "page": 1,
+            "page": page,
             "per_page": perPage,
-            "sort": "updated_at",
+            "sort": sort,
         }
     }
+    if scene_filter:
+        variables["scene_filter"] = scene_filter
     result = callGraphQL(query, variables)
     return result.get("findScenes")
 
 
+def graphql_findScene_pages(perPage, after_id=0):
+    """Yield every page of scenes with an id above `after_id`, sorted by id.
+
+    Pages are requested with an id filter instead of a page number, so renaming
+    scenes during the walk can't shift the pages. The next page is fetched in
+    the background while the caller works on the current one.
+    """
+
+    def fetch(last_id):
+        return graphql_findScene(
+            perPage,
+            "ASC",
+            sort="id",
+            scene_filter={"id": {"modifier": "GREATER_THAN", "value": last_id}},
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        scenes = fetch(after_id)
+        while scenes["scenes"]:
+            next_scenes = None
+            if len(scenes["scenes"]) == perPage:
+                next_scenes = executor.submit(fetch, int(scenes["scenes"][-1]["id"]))
+            yield scenes
+            if next_scenes is None:
+                break
+            scenes = next_scenes.result()
+
+
+def graphql_findScene_updated_pages(perPage, after=None):
+    """Yield the pages of scenes updated after `after` (updated_at), oldest first.
+
+    updated_at isn't unique: the scenes sharing the last timestamp of a full page
+    are left for the next page, which is requested with updated_at above the
+    previous timestamp. Each page has a "watermark", every scene updated up to
+    it has been yielded.
+    """
+    count = None
+    per_page = perPage
+    while True:
+        scene_filter = None
+        if after:
+            scene_filter = {"updated_at": {"modifier": "GREATER_THAN", "value": after}}
+        scenes = graphql_findScene(
+            per_page, "ASC", sort="updated_at", scene_filter=scene_filter
+        )
+        page = scenes["scenes"]
+        if not page:
+            return
+        if count is None:
+            count = scenes["count"]
+        last = page[-1]["updated_at"]
+        if len(page) < per_page:
+            yield {"count": count, "scenes": page, "watermark": last}
+            return
+        if page[0]["updated_at"] == last:
+            # the whole page has the same timestamp, ask for more at once
+            per_page *= 2
+            continue
+        page = [scene for scene in page if scene["updated_at"] != last]
+        after = page[-1]["updated_at"]
+        per_page = perPage
+        yield {"count": count, "scenes": page, "watermark": after}
+
+
 # used to find duplicate
 def graphql_findScenebyPath(path, modifier) -> dict:
     query = """
@@ -267,6 +425,9 @@ def graphql_getConfiguration():
             configuration {
                 general {
                     databasePath
+                    stashes {
+                        path
+                    }
                 }
             }
         }
@@ -293,6 +454,29 @@ def graphql_getStudio(studio_id):
     return result.get("findStudio")
 
 
+def graphql_findStudios(perPage, page=1) -> dict:
+    query = """
+        query FindStudios($filter: FindFilterType) {
+            findStudios(filter: $filter) {
+                count
+                studios {
+                    id
+                    name
+                    parent_studio {
+                        id
+                        name
+                    }
+                }
+            }
+        }
+    """
+    variables = {
+        "filter": {"direction": "ASC", "page": page, "per_page": perPage, "sort": "id"}
+    }
+    result = callGraphQL(query, variables)
+    return result.get("findStudios")
+
+
 def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     query = """
     mutation BulkSceneUpdate($input: BulkSceneUpdateInput!) {
@@ -345,73 +529,110 @@ def find_diff_text(a: str, b: str):
     return
 
 
-def has_handle(fpath, all_result=False):
-    lst = []
+@timing.timed("handle hunt")
+def has_handle(fpath, all_result=False) -> list:
+    if None not in OPEN_FILES:
+        load_open_files()
+    pids = OPEN_FILES.get(fpath, [])
+    if all_result:
+        return pids
+    return pids[:1]
+
+
+def load_open_files():
+    # Listing the open files of every process is slow, it's done once and used
+    # for the next failed moves, even for the files no process has open
+    # (cleared for every page of the task renamer). The None key marks the
+    # listing as done.
+    OPEN_FILES.clear()
+    OPEN_FILES[None] = []
     for proc in psutil.process_iter():
         try:
             for item in proc.open_files():
-                if fpath == item.path:
-                    if all_result:
-                        lst.append(proc)
-                    else:
-                        return proc
+                pids = OPEN_FILES.setdefault(item.path, [])
+                if proc.pid not in pids:
+                    pids.append(proc.pid)
         except Exception:
             pass
-    return lst
 
 
-def config_edit(name: str, state: bool):
-    found = 0
-    try:
-        with open(config.__file__, "r", encoding="utf8") as file:
-            config_lines = file.readlines()
-        with open(config.__file__, "w", encoding="utf8") as file_w:
-            for line in config_lines:
-                if len(line.split("=")) > 1:
-                    if name == line.split("=")[0].strip():
-                        file_w.write(f"{name} = {state}\n")
-                        found += 1
-                        continue
-                file_w.write(line)
-    except PermissionError as err:
-        log.LogError(f"You don't have the permission to edit config.py ({err})")
-    return found
+def checkpoint_load() -> int:
+    if not BULK_CHECKPOINT:
+        return 0
+    return int(STATE.get("checkpoint", 0))
+
+
+def checkpoint_save(scene_id):
+    if not BULK_CHECKPOINT or DRY_RUN:
+        return
+    STATE.set("checkpoint", int(scene_id))
+
+
+def checkpoint_clear():
+    STATE.delete("checkpoint")
+
+
+def watermark_load():
+    return STATE.get("watermark")
+
+
+def watermark_save(updated_at):
+    if DRY_RUN:
+        return
+    STATE.set("watermark", updated_at)
 
 
 def check_longpath(path: str):
     # Trying to prevent error with long paths for Win10
     # https://docs.microsoft.com/en-us/windows/win32/fileio/maximum-file-path-limitation?tabs=cmd
-    if len(path) > 240 and not IGNORE_PATH_LENGTH:
+    if len(path) > PATH_LENGTH_LIMIT and not IGNORE_PATH_LENGTH:
         log.LogError(
-            f"The path is too long ({len(path)} > 240). You can look at 'order_field'/'ignore_path_length' in config."
+            f"The path is too long ({len(path)} > {PATH_LENGTH_LIMIT}). You can look at 'order_field'/'truncate_field'/'ignore_path_length' in config."
         )
         return 1
 
 
+def load_studio_cache():
+    page = 1
+    while True:
+        studios = graphql_findStudios(STUDIO_PAGE_SIZE, page)
+        for studio in studios["studios"]:
+            STUDIO_CACHE[studio["id"]] = studio
+        if page * STUDIO_PAGE_SIZE >= studios["count"] or not studios["studios"]:
+            break
+        page += 1
+    log.LogDebug(f"[STUDIO] {len(STUDIO_CACHE)} studios loaded")
+
+
+def get_studio(studio_id):
+    if studio_id not in STUDIO_CACHE:
+        STUDIO_CACHE[studio_id] = graphql_getStudio(studio_id)
+    return STUDIO_CACHE[studio_id]
+
+
+def get_studio_hierarchy(studio: dict) -> list:
+    # the studio then its parents, up to the top one
+    hierarchy = [studio]
+    while studio.get("parent_studio"):
+        studio = get_studio(studio["parent_studio"]["id"])
+        if not studio:
+            break
+        hierarchy.append(studio)
+    return hierarchy
+
+
 def get_template_filename(scene: dict):
     template = None
     # Change by Studio
     if scene.get("studio") and config.studio_templates:
-        template_found = False
-        current_studio = scene.get("studio")
-        if config.studio_templates.get(current_studio["name"]):
-            template = config.studio_templates[current_studio["name"]]
-            template_found = True
-        # by first Parent found
-        while current_studio.get("parent_studio") and not template_found:
-            if config.studio_templates.get(
-                current_studio.get("parent_studio").get("name")
-            ):
-                template = config.studio_templates[
-                    current_studio["parent_studio"]["name"]
-                ]
-                template_found = True
-            current_studio = graphql_getStudio(
-                current_studio.get("parent_studio")["id"]
-            )
+        # the studio, else by first Parent found
+        for studio in get_studio_hierarchy(scene["studio"]):
+            if config.studio_templates.get(studio["name"]):
+                template = config.studio_templates[studio["name"]]
+                break
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
+    tags = [x["name"] for x in scene.get("tags", [])]
     if scene.get("tags") and config.tag_templates:
         for match, job in config.tag_templates.items():
             if match in tags:
@@ -441,7 +662,7 @@ def get_template_path(scene: dict):
                 ]
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
+    tags = [x["name"] for x in scene.get("tags", [])]
     if scene.get("tags") and config.p_tag_templates:
         for match, job in config.p_tag_templates.items():
             if match in tags:
@@ -463,7 +684,9 @@ def get_template_path(scene: dict):
     return template
 
 
-def sort_performer(lst_use: list, lst_app=[]):
+def sort_performer(lst_use: list, lst_app=None):
+    if lst_app is None:
+        lst_app = []
     for p in lst_use:
         lst_use[p].sort()
     for p in lst_use.values():
@@ -480,57 +703,17 @@ def sort_rating(d: dict):
     return new_d
 
 
-def extract_info(scene: dict, template: None):
+def extract_scene_info(scene: dict, template: None):
+    """What only depends on the scene, shared by all its files."""
     # Grabbing things from Stash
     scene_information = {}
 
-    scene_information["current_path"] = str(scene["path"])
-    # note: contain the dot (.mp4)
-    scene_information["file_extension"] = os.path.splitext(
-        scene_information["current_path"]
-    )[1]
-    # note: basename contains the extension
-    scene_information["current_filename"] = os.path.basename(
-        scene_information["current_path"]
-    )
-    scene_information["current_directory"] = os.path.dirname(
-        scene_information["current_path"]
-    )
-    scene_information["oshash"] = scene.get("oshash")
-    scene_information["checksum"] = scene.get("checksum")
     scene_information["studio_code"] = scene.get("code")
 
     if scene.get("stash_ids"):
         # todo support other db that stashdb ?
         scene_information["stashid_scene"] = scene["stash_ids"][0]["stash_id"]
 
-    if template.get("path"):
-        if "^*" in template["path"]["destination"]:
-            template["path"]["destination"] = template["path"]["destination"].replace(
-                "^*", scene_information["current_directory"]
-            )
-        scene_information["template_split"] = os.path.normpath(
-            template["path"]["destination"]
-        ).split(os.sep)
-    scene_information["current_path_split"] = os.path.normpath(
-        scene_information["current_path"]
-    ).split(os.sep)
-
-    if FILENAME_ASTITLE and not scene.get("title"):
-        scene["title"] = scene_information["current_filename"]
-
-    # Grab Title (without extension if present)
-    if scene.get("title"):
-        # Removing extension if present in title
-        scene_information["title"] = re.sub(
-            rf"{scene_information['file_extension']}$", "", scene["title"]
-        )
-        if PREPOSITIONS_REMOVAL:
-            for word in PREPOSITIONS_LIST:
-                scene_information["title"] = re.sub(
-                    rf"^{word}[\s_-]", "", scene_information["title"]
-                )
-
     # Grab Date
     scene_information["date"] = scene.get("date")
     if scene_information["date"]:
@@ -539,21 +722,15 @@ def extract_info(scene: dict, template: None):
             date_scene, config.date_format
         )
 
-    # Grab Duration
-    scene_information["duration"] = scene["file"]["duration"]
-    if config.duration_format:
-        scene_information["duration"] = time.strftime(
-            config.duration_format, time.gmtime(scene_information["duration"])
-        )
-    else:
-        scene_information["duration"] = str(scene_information["duration"])
-
     # Grab Rating
     if scene.get("rating100"):
         scene_information["rating"] = RATING_FORMAT.format(scene["rating100"])
 
     # Grab Performer
-    scene_information["performer_path"] = None
+    # the folder of the performer can depend on the path of the file, what it
+    # needs is kept for extract_file_info.
+    performer_path = {"names": [], "first": None, "all": None}
+    scene_information["_performer_path"] = performer_path
     if scene.get("performers"):
         perf_list = []
         perf_list_stashid = []
@@ -582,16 +759,7 @@ def extract_info(scene: dict, template: None):
                 perf_favorite["yes"].append(perf["name"])
             else:
                 perf_favorite["no"].append(perf["name"])
-            # if the path already contains the name we keep this one
-            if (
-                perf["name"] in scene_information["current_path_split"]
-                and scene_information.get("performer_path") is None
-                and PATH_KEEP_ALRPERF
-            ):
-                scene_information["performer_path"] = perf["name"]
-                log.LogDebug(
-                    f"[PATH] Keeping the current name of the performer '{perf['name']}'"
-                )
+        performer_path["names"] = list(perf_list)
         perf_rating = sort_rating(perf_rating)
         # sort performer
         if PERFORMER_SORT == "rating":
@@ -616,8 +784,8 @@ def extract_info(scene: dict, template: None):
                         perf_list.append(n)
         elif PERFORMER_SORT == "name":
             perf_list.sort()
-        if not scene_information["performer_path"] and perf_list:
-            scene_information["performer_path"] = perf_list[0]
+        if perf_list:
+            performer_path["first"] = perf_list[0]
         if len(perf_list) > PERFORMER_LIMIT:
             if not PERFORMER_LIMIT_KEEP:
                 log.LogInfo(
@@ -639,9 +807,7 @@ def extract_info(scene: dict, template: None):
                 perf_list_stashid
             )
         if not PATH_ONEPERFORMER:
-            scene_information["performer_path"] = PERFORMER_SPLITCHAR.join(perf_list)
-    elif PATH_NOPERFORMER_FOLDER:
-        scene_information["performer_path"] = "NoPerformer"
+            performer_path["all"] = PERFORMER_SPLITCHAR.join(perf_list)
 
     # Grab Studio name
     if scene.get("studio"):
@@ -663,14 +829,11 @@ def extract_info(scene: dict, template: None):
                 ]
             scene_information["studio_family"] = scene_information["parent_studio"]
 
-            studio_p = scene["studio"]
-            while studio_p.get("parent_studio"):
-                studio_p = graphql_getStudio(studio_p["parent_studio"]["id"])
-                if studio_p:
-                    if SQUEEZE_STUDIO_NAMES:
-                        studio_hierarchy.append(studio_p["name"].replace(" ", ""))
-                    else:
-                        studio_hierarchy.append(studio_p["name"])
+            for studio_p in get_studio_hierarchy(scene["studio"])[1:]:
+                if SQUEEZE_STUDIO_NAMES:
+                    studio_hierarchy.append(studio_p["name"].replace(" ", ""))
+                else:
+                    studio_hierarchy.append(studio_p["name"])
             studio_hierarchy.reverse()
         scene_information["studio_hierarchy"] = studio_hierarchy
     # Grab Tags
@@ -688,6 +851,98 @@ def extract_info(scene: dict, template: None):
                 tag_list.append(tag["name"])
         scene_information["tags"] = TAGS_SPLITCHAR.join(tag_list)
 
+    if scene.get("movies"):
+        scene_information["movie_title"] = scene["movies"][0]["movie"]["name"]
+        if scene["movies"][0]["movie"].get("date"):
+            scene_information["movie_year"] = scene["movies"][0]["movie"]["date"][0:4]
+        if scene["movies"][0].get("scene_index"):
+            scene_information["movie_index"] = scene["movies"][0]["scene_index"]
+            scene_information["movie_scene"] = (
+                f"scene {scene_information['movie_index']}"
+            )
+
+    if scene_information.get("date"):
+        scene_information["year"] = scene_information["date"][0:4]
+
+    replace_whitespace(scene_information)
+    return scene_information
+
+
+def extract_file_info(scene: dict, template: None, scene_part: dict):
+    """The information of the current file of the scene, added to `scene_part`."""
+    scene_information = {}
+
+    scene_information["current_path"] = str(scene["path"])
+    # note: contain the dot (.mp4)
+    scene_information["file_extension"] = os.path.splitext(
+        scene_information["current_path"]
+    )[1]
+    # note: basename contains the extension
+    scene_information["current_filename"] = os.path.basename(
+        scene_information["current_path"]
+    )
+    scene_information["current_directory"] = os.path.dirname(
+        scene_information["current_path"]
+    )
+    scene_information["oshash"] = scene.get("oshash")
+    scene_information["checksum"] = scene.get("checksum")
+
+    if template.get("path"):
+        if "^*" in template["path"]["destination"]:
+            template["path"]["destination"] = template["path"]["destination"].replace(
+                "^*", scene_information["current_directory"]
+            )
+        scene_information["template_split"] = os.path.normpath(
+            template["path"]["destination"]
+        ).split(os.sep)
+    scene_information["current_path_split"] = os.path.normpath(
+        scene_information["current_path"]
+    ).split(os.sep)
+
+    if FILENAME_ASTITLE and not scene.get("title"):
+        scene["title"] = scene_information["current_filename"]
+
+    # Grab Title (without extension if present)
+    if scene.get("title"):
+        # Removing extension if present in title
+        scene_information["title"] = re.sub(
+            rf"{scene_information['file_extension']}$", "", scene["title"]
+        )
+        if PREPOSITIONS_REMOVAL:
+            for word in PREPOSITIONS_LIST:
+                scene_information["title"] = re.sub(
+                    rf"^{word}[\s_-]", "", scene_information["title"]
+                )
+
+    # Grab Duration
+    scene_information["duration"] = scene["file"]["duration"]
+    if config.duration_format:
+        scene_information["duration"] = time.strftime(
+            config.duration_format, time.gmtime(scene_information["duration"])
+        )
+    else:
+        scene_information["duration"] = str(scene_information["duration"])
+
+    # Grab Performer folder
+    scene_information["performer_path"] = None
+    performer_path = scene_part["_performer_path"]
+    if scene.get("performers"):
+        # if the path already contains the name we keep this one
+        if PATH_KEEP_ALRPERF:
+            for name in performer_path["names"]:
+                if name in scene_information["current_path_split"]:
+                    scene_information["performer_path"] = name
+                    log.LogDebug(
+                        f"[PATH] Keeping the current name of the performer '{name}'"
+                    )
+                    break
+        if not scene_information["performer_path"]:
+            scene_information["performer_path"] = performer_path["first"]
+        if not PATH_ONEPERFORMER:
+            scene_information["performer_path"] = performer_path["all"]
+    elif PATH_NOPERFORMER_FOLDER:
+        scene_information["performer_path"] = "NoPerformer"
+
     # Grab Height (720p,1080p,4k...)
     scene_information["bit_rate"] = str(
         round(int(scene["file"]["bit_rate"]) / 1000000, 2)
@@ -709,137 +964,57 @@ def extract_info(scene: dict, template: None):
     if scene["file"]["height"] > scene["file"]["width"]:
         scene_information["resolution"] = "VERTICAL"
 
-    if scene.get("movies"):
-        scene_information["movie_title"] = scene["movies"][0]["movie"]["name"]
-        if scene["movies"][0]["movie"].get("date"):
-            scene_information["movie_year"] = scene["movies"][0]["movie"]["date"][0:4]
-        if scene["movies"][0].get("scene_index"):
-            scene_information["movie_index"] = scene["movies"][0]["scene_index"]
-            scene_information["movie_scene"] = (
-                f"scene {scene_information['movie_index']}"
-            )
-
     # Grab Video and Audio codec
     scene_information["video_codec"] = scene["file"]["video_codec"].upper()
     scene_information["audio_codec"] = scene["file"]["audio_codec"].upper()
 
-    if scene_information.get("date"):
-        scene_information["year"] = scene_information["date"][0:4]
-
-    if FIELD_WHITESPACE_SEP:
-        for key, value in scene_information.items():
-            if key in [
-                "current_path",
-                "current_filename",
-                "current_directory",
-                "current_path_split",
-                "template_split",
-            ]:
-                continue
-            if type(value) is str:
-                scene_information[key] = value.replace(" ", FIELD_WHITESPACE_SEP)
-            elif type(value) is list:
-                scene_information[key] = [
-                    x.replace(" ", FIELD_WHITESPACE_SEP) for x in value
-                ]
+    replace_whitespace(scene_information)
+    scene_information.update(
+        (key, value) for key, value in scene_part.items() if key != "_performer_path"
+    )
     return scene_information
 
 
-def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
-        if type(new) is str:
-            new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
-            else:
-                if new[1] == "word":
-                    tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
-        else:
-            tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
-            if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
-        text = tmp
-    return tmp
+def replace_whitespace(scene_information: dict):
+    if not FIELD_WHITESPACE_SEP:
+        return
+    for key, value in scene_information.items():
+        if key in [
+            "current_path",
+            "current_filename",
+            "current_directory",
+            "current_path_split",
+            "template_split",
+        ]:
+            continue
+        if type(value) is str:
+            scene_information[key] = value.replace(" ", FIELD_WHITESPACE_SEP)
+        elif type(value) is list:
+            scene_information[key] = [
+                x.replace(" ", FIELD_WHITESPACE_SEP) for x in value
+            ]
 
 
-def cleanup_text(text: str):
-    text = re.sub(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}", "", text)
-    text = re.sub(r"[{}]", "", text)
-    text = remove_consecutive_nonword(text)
-    return text.strip(" -_.")
+def replace_text(text: str):
+    return template_engine.replace_words(REPLACE_WORDS_STAGES, text)
 
 
-def remove_consecutive_nonword(text: str):
-    for _ in range(0, 10):
-        m = re.findall(r"(\W+)\1+", text)
-        if m:
-            text = re.sub(r"(\W+)\1+", r"\1", text)
-        else:
-            break
-    return text
-
-
-def field_replacer(text: str, scene_information: dict):
-    field_found = re.findall(r"\$\w+", text)
-    result = text
-    title = None
-    replaced_word = ""
-    if field_found:
-        field_found.sort(key=len, reverse=True)
-    for i in range(0, len(field_found)):
-        f = field_found[i].replace("$", "").strip("_")
-        # If $performer is before $title, prevent having duplicate text.
-        if (
-            f == "performer"
-            and len(field_found) > i + 1
-            and scene_information.get("performer")
-        ):
-            if (
-                field_found[i + 1] == "$title"
-                and scene_information.get("title")
-                and PREVENT_TITLE_PERF
-            ):
-                if re.search(
-                    f"^{scene_information['performer'].lower()}",
-                    scene_information["title"].lower(),
-                ):
-                    log.LogDebug(
-                        "Ignoring the performer field because it's already in start of title"
-                    )
-                    result = result.replace("$performer", "")
-                    continue
-        replaced_word = scene_information.get(f)
-        if not replaced_word:
-            replaced_word = ""
-        if FIELD_REPLACER.get(f"${f}"):
-            replaced_word = replaced_word.replace(
-                FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"]
-            )
-        if f == "title":
-            title = replaced_word.strip()
-            continue
-        if replaced_word == "":
-            result = result.replace(field_found[i], replaced_word)
-        else:
-            result = result.replace(f"${f}", replaced_word)
-    return result, title
+def get_template(text: str) -> dict:
+    # each template is compiled once, then reused for every scene
+    if text not in TEMPLATE_CACHE:
+        TEMPLATE_CACHE[text] = template_engine.compile_template(
+            text, FIELD_REPLACER, PREVENT_TITLE_PERF
+        )
+    return TEMPLATE_CACHE[text]
 
 
 def makeFilename(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    r, t = field_replacer(new_filename, scene_information)
+    r, t = template_engine.render_template(get_template(query), scene_information)
     if FILENAME_REPLACEWORDS:
         r = replace_text(r)
     if not t:
         r = r.replace("$title", "")
-    r = cleanup_text(r)
+    r = template_engine.cleanup_text(r)
     if t:
         r = r.replace("$title", t)
     # Replace spaces with splitchar
@@ -848,12 +1023,13 @@ def makeFilename(scene_information: dict, query: str) -> str:
 
 
 def makePath(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    new_filename = new_filename.replace("$performer", "$performer_path")
-    r, t = field_replacer(new_filename, scene_information)
+    new_filename = str(query).replace("$performer", "$performer_path")
+    r, t = template_engine.render_template(
+        get_template(new_filename), scene_information
+    )
     if not t:
         r = r.replace("$title", "")
-    r = cleanup_text(r)
+    r = template_engine.cleanup_text(r)
     if t:
         r = r.replace("$title", t)
     return r
@@ -892,11 +1068,12 @@ def capitalizeWords(s: str) -> str:
     # Function to capitalize words based on their position and value.
     def process_word(match):
         word = match.group(0)
+        # Only the exceptions depend on their position, the other words are
+        # capitalized wherever they are.
+        if word.lower() not in TITLECASE_EXCEPTIONS:
+            return titlecase_word(word)
         preceding_char, following_char = None, None
 
-        # List of words to avoid capitalizing if found between other words.
-        exceptions = {"and", "of", "the"}
-
         # Find the nearest non-space character before the current word
         if match.start() > 0:
             for i in range(match.start() - 1, -1, -1):
@@ -915,18 +1092,48 @@ def capitalizeWords(s: str) -> str:
         if (
             match.start() == 0
             or match.end() == len(s)
-            or word.lower() not in exceptions
             or (preceding_char and not preceding_char.isalnum())
             or (following_char and not following_char.isalnum())
         ):
-            return word.capitalize()
+            return titlecase_word(word)
         else:
             return word.lower()
 
     # Apply the regex pattern and the process_word function.
-    return re.sub(r"\b[A-Z]?[a-z\'\u2019\u2018]+\b", process_word, s)
+    return TITLECASE_WORD_REGEX.sub(process_word, s)
+
+
+# The same performer, studio, tag and movie names come back in most of the
+# filenames, their words (title case) and their non-ASCII parts (unidecode) are
+# normalized once, the LRU keeps the most used ones.
+@functools.lru_cache(maxsize=4096)
+def titlecase_word(word: str) -> str:
+    return word.capitalize()
+
+
+@functools.lru_cache(maxsize=4096)
+def _ascii_run(run: str) -> str:
+    return unidecode.unidecode(run, errors="preserve")
+
 
+def to_ascii(text: str) -> str:
+    # unidecode replaces each character on its own, only the non-ASCII runs
+    # need it.
+    return NON_ASCII_REGEX.sub(lambda match: _ascii_run(match.group()), text)
 
+
+def log_normalization_cache():
+    for name, fn in (("Title case", titlecase_word), ("Unidecode", _ascii_run)):
+        info = fn.cache_info()
+        lookups = info.hits + info.misses
+        if lookups:
+            log.LogDebug(
+                f"{name} cache: {info.hits}/{lookups} hits "
+                f"({info.hits / lookups:.0%}), {info.currsize} entries"
+            )
+
+
+@timing.timed("render filename")
 def create_new_filename(scene_info: dict, template: str):
     new_filename = (
         makeFilename(scene_info, template)
@@ -938,20 +1145,110 @@ def create_new_filename(scene_info: dict, template: str):
     if FILENAME_TITLECASE:
         new_filename = capitalizeWords(new_filename)
     # Remove illegal character for Windows
-    new_filename = re.sub('[\\/:"*?<>|]+', "", new_filename)
+    new_filename = ILLEGAL_CHARACTER_REGEX.sub("", new_filename)
 
-    if FILENAME_REMOVECHARACTER:
-        new_filename = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", new_filename)
+    if REMOVECHARACTER_REGEX:
+        new_filename = REMOVECHARACTER_REGEX.sub("", new_filename)
 
     # Trying to remove non standard character
     if MODULE_UNIDECODE and UNICODE_USE:
-        new_filename = unidecode.unidecode(new_filename, errors="preserve")
+        new_filename = to_ascii(new_filename)
     else:
         # Using typewriter for Apostrophe
-        new_filename = re.sub("[’‘”“]+", "'", new_filename)
+        new_filename = APOSTROPHE_REGEX.sub("'", new_filename)
     return new_filename
 
 
+def render_new_path(scene_info: dict, template: dict):
+    if template["filename"]:
+        new_filename = create_new_filename(scene_info, template["filename"])
+    else:
+        new_filename = scene_info["current_filename"]
+    if template.get("path"):
+        new_directory = create_new_path(scene_info, template)
+    else:
+        new_directory = scene_info["current_directory"]
+    return new_filename, new_directory, os.path.join(new_directory, new_filename)
+
+
+def fit_path_length(scene_info: dict, template: dict):
+    """Set the new filename/directory/path, shortened if the path is too long.
+
+    The fields of ORDER_SHORTFIELD are removed in order until the path fits. The
+    length of each field in the templates gives how many fields to remove, the
+    path is then rendered with fewer/more fields until it's the first that fits.
+    If it's still too long, the fields of TRUNCATE_FIELD are cut.
+    """
+    rendered = {0: render_new_path(scene_info, template)}
+    if IGNORE_PATH_LENGTH or len(rendered[0][2]) <= PATH_LENGTH_LIMIT:
+        set_new_path(scene_info, rendered[0])
+        return
+
+    text = template["filename"] or ""
+    if template.get("path"):
+        text += " " + template["path"]["destination"]
+    used = collections.Counter(
+        "$" + field[1:].strip("_")
+        for field in template_engine.FIELD_REGEX.findall(text)
+    )
+    fields = []
+    for field in ORDER_SHORTFIELD:
+        key = field.replace("$", "")
+        if scene_info.get(key):
+            fields.append((field, key, scene_info[key]))
+
+    def render(count):
+        # the path without the first `count` fields
+        if count not in rendered:
+            for _, key, value in fields:
+                scene_info[key] = value
+            for _, key, _ in fields[:count]:
+                del scene_info[key]
+            rendered[count] = render_new_path(scene_info, template)
+        return len(rendered[count][2]) <= PATH_LENGTH_LIMIT
+
+    excess = len(rendered[0][2]) - PATH_LENGTH_LIMIT
+    count = 0
+    while count < len(fields) and excess > 0:
+        excess -= len(str(fields[count][2])) * used[f"${fields[count][1]}"]
+        count += 1
+    # the separators going with a field aren't counted, fewer fields could be enough.
+    if render(count):
+        while count > 0 and render(count - 1):
+            count -= 1
+    else:
+        while not render(count) and count < len(fields):
+            count += 1
+    for _, key, value in fields:
+        scene_info[key] = value
+    for field, key, _ in fields[:count]:
+        del scene_info[key]
+        log.LogWarning(f"removed {field} to reduce the length path")
+    new_path = rendered[count]
+
+    for field in TRUNCATE_FIELD:
+        excess = len(new_path[2]) - PATH_LENGTH_LIMIT
+        if excess <= 0:
+            break
+        key = field.replace("$", "")
+        value = scene_info.get(key)
+        if not value or type(value) is not str:
+            continue
+        cut = -(-excess // max(1, used[f"${key}"]))
+        scene_info[key] = value[: max(0, len(value) - cut)].rstrip()
+        new_path = render_new_path(scene_info, template)
+        log.LogWarning(f"cut {field} to reduce the length path")
+    set_new_path(scene_info, new_path)
+
+
+def set_new_path(scene_info: dict, new_path: tuple):
+    (
+        scene_info["new_filename"],
+        scene_info["new_directory"],
+        scene_info["final_path"],
+    ) = new_path
+
+
 def remove_consecutive(liste: list):
     new_list = []
     for i in range(0, len(liste)):
@@ -961,6 +1258,7 @@ def remove_consecutive(liste: list):
     return new_list
 
 
+@timing.timed("render path")
 def create_new_path(scene_info: dict, template: dict):
     # Create the new path
     # Split the template path
@@ -973,10 +1271,10 @@ def create_new_path(scene_info: dict, template: dict):
             if not scene_info.get("studio_hierarchy"):
                 continue
             for p in scene_info["studio_hierarchy"]:
-                path_list.append(re.sub('[\\/:"*?<>|]+', "", p).strip())
+                path_list.append(ILLEGAL_CHARACTER_REGEX.sub("", p).strip())
         else:
             path_list.append(
-                re.sub('[\\/:"*?<>|]+', "", makePath(scene_info, part)).strip()
+                ILLEGAL_CHARACTER_REGEX.sub("", makePath(scene_info, part)).strip()
             )
     # Remove blank, empty string
     path_split = [x for x in path_list if x]
@@ -994,18 +1292,19 @@ def create_new_path(scene_info: dict, template: dict):
 
     path_edited = os.sep.join(path_split)
 
-    if FILENAME_REMOVECHARACTER:
-        path_edited = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", path_edited)
+    if REMOVECHARACTER_REGEX:
+        path_edited = REMOVECHARACTER_REGEX.sub("", path_edited)
 
     # Using typewriter for Apostrophe
-    new_path = re.sub("[’‘”“]+", "'", path_edited)
+    new_path = APOSTROPHE_REGEX.sub("'", path_edited)
 
     return new_path
 
 
 def connect_db(path: str):
     try:
-        sqliteConnection = sqlite3.connect(path, timeout=10)
+        # the task renamer can write from another thread (bulk_workers)
+        sqliteConnection = sqlite3.connect(path, timeout=10, check_same_thread=False)
         log.LogDebug("Python successfully connected to SQLite")
     except sqlite3.Error as error:
         log.LogError(f"FATAL SQLITE Error: {error}")
@@ -1013,7 +1312,10 @@ def connect_db(path: str):
     return sqliteConnection
 
 
+@timing.timed("duplicate check")
 def checking_duplicate_db(scene_info: dict):
+    if PATH_INDEX.loaded:
+        return checking_duplicate_index(scene_info)
     scenes = graphql_findScenebyPath(scene_info["final_path"], "EQUALS")
     if scenes["count"] > 0:
         log.LogError("Duplicate path detected")
@@ -1027,6 +1329,19 @@ def checking_duplicate_db(scene_info: dict):
                 log.LogWarning(f"Duplicate filename: [{dupl_row['id']}]")
 
 
+def checking_duplicate_index(scene_info: dict):
+    scenes = PATH_INDEX.scenes_with_path(scene_info["final_path"])
+    if scenes is not None:
+        log.LogError("Duplicate path detected")
+        for scene_id in scenes:
+            log.LogWarning(f"Identical path: [{scene_id}]")
+        return 1
+    for scene_id in PATH_INDEX.scenes_with_basename(scene_info["new_filename"]):
+        if scene_id != str(scene_info["scene_id"]):
+            log.LogWarning(f"Duplicate filename: [{scene_id}]")
+
+
+@timing.timed("sqlite rename")
 def db_rename(stash_db: sqlite3.Connection, scene_info):
     cursor = stash_db.cursor()
     # Database rename
@@ -1039,6 +1354,7 @@ def db_rename(stash_db: sqlite3.Connection, scene_info):
     cursor.close()
 
 
+@timing.timed("sqlite rename")
 def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
     cursor = stash_db.cursor()
     # 2022-09-17T11:25:52+02:00
@@ -1115,6 +1431,7 @@ def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
         )
 
 
+@timing.timed("move")
 def file_rename(current_path: str, new_path: str, scene_info: dict):
     # OS Rename
     if not os.path.isfile(current_path):
@@ -1127,7 +1444,7 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
         log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
         os.makedirs(new_dir)
     try:
-        shutil.move(current_path, new_path)
+        mover.move_file(current_path, new_path, MOVE_PROGRESS, MOVE_VERIFY_HASH)
     except PermissionError as err:
         if "[WinError 32]" in str(err) and MODULE_PSUTIL:
             log.LogWarning(
@@ -1139,12 +1456,16 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                 # Terminate the process then try again to rename
                 log.LogDebug(f"Process that uses this file: {process_use}")
                 if PROCESS_KILL:
-                    p = psutil.Process(process_use.pid)
-                    p.terminate()
-                    p.wait(10)
+                    for pid in process_use:
+                        p = psutil.Process(pid)
+                        p.terminate()
+                        p.wait(10)
+                    OPEN_FILES.clear()
                     # If process is not terminated, this will create an error again.
                     try:
-                        shutil.move(current_path, new_path)
+                        mover.move_file(
+                            current_path, new_path, MOVE_PROGRESS, MOVE_VERIFY_HASH
+                        )
                     except Exception as err:
                         log.LogError(
                             f"Something still prevents renaming the file. {err}"
@@ -1166,12 +1487,15 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                         f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}\n"
                     )
             except Exception as err:
-                shutil.move(new_path, current_path)
+                mover.move_file(new_path, current_path)
                 log.LogError(
                     f"Restoring the original path, error writing the logfile: {err}"
                 )
                 return 1
-        if REMOVE_EMPTY_FOLDER:
+        if VACATED_FOLDERS is not None:
+            # removed at the end of the task, see remove_empty_folders
+            VACATED_FOLDERS.add(current_dir)
+        elif REMOVE_EMPTY_FOLDER:
             with os.scandir(current_dir) as it:
                 if not any(it):
                     log.LogInfo(f"Removing empty folder ({current_dir})")
@@ -1187,33 +1511,122 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
         return 1
 
 
+def remove_empty_folders(db_batch=None):
+    """Remove the folders emptied by the task, the deepest first.
+
+    With REMOVE_EMPTY_PARENTS, a removed folder's parent is checked too, up to
+    the library folder. The folders are removed from the database with the
+    renames not committed yet.
+    """
+    libraries = [
+        os.path.normpath(stash["path"])
+        for stash in STASH_CONFIG["general"].get("stashes") or []
+    ]
+    queued = set(VACATED_FOLDERS)
+    VACATED_FOLDERS.clear()
+    pending = [(-directory.count(os.sep), directory) for directory in queued]
+    heapq.heapify(pending)
+    while pending:
+        _, directory = heapq.heappop(pending)
+        if os.path.normpath(directory) in libraries:
+            continue
+        try:
+            os.rmdir(directory)
+        except OSError as err:
+            if err.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                log.LogWarning(f"Fail to delete empty folder {directory} - {err}")
+            continue
+        log.LogInfo(f"Removing empty folder ({directory})")
+        if db_batch:
+            db_batch.remove_folder(directory)
+        parent = os.path.dirname(directory)
+        if (
+            REMOVE_EMPTY_PARENTS
+            and parent not in queued
+            and any(
+                os.path.normpath(parent).startswith(library + os.sep)
+                for library in libraries
+            )
+        ):
+            queued.add(parent)
+            heapq.heappush(pending, (-parent.count(os.sep), parent))
+
+
+def list_directory(directory: str) -> set:
+    """Names of the files in the directory. Listed once, then kept for the batch (DIR_LISTING)."""
+    names = DIR_LISTING.get(directory)
+    if names is None:
+        try:
+            with os.scandir(directory) as it:
+                names = {entry.name for entry in it if entry.is_file()}
+        except OSError:
+            names = set()
+        DIR_LISTING[directory] = names
+    return names
+
+
+def listing_moved(old_path: str, new_path: str):
+    names = DIR_LISTING.get(os.path.dirname(old_path))
+    if names is not None:
+        names.discard(os.path.basename(old_path))
+    names = DIR_LISTING.get(os.path.dirname(new_path))
+    if names is not None:
+        names.add(os.path.basename(new_path))
+
+
+def associated_files(scene_info: dict) -> list:
+    """[old path, new path] of the files next to the scene with the same name."""
+    files = []
+    if not ASSOCIATED_EXT and not ASSOCIATED_PATTERN:
+        return files
+    directory, filename = os.path.split(scene_info["current_path"])
+    stem = os.path.splitext(filename)[0]
+    new_stem = os.path.splitext(scene_info["final_path"])[0]
+    extensions = {os.path.normcase(f".{ext}") for ext in ASSOCIATED_EXT or []}
+    for name in sorted(list_directory(directory)):
+        if name == filename or not os.path.normcase(name).startswith(
+            os.path.normcase(stem)
+        ):
+            continue
+        # the end of the name is kept: name.en.srt -> new_name.en.srt
+        suffix = name[len(stem) :]
+        if os.path.normcase(suffix) in extensions or any(
+            fnmatch.fnmatch(suffix, pattern) for pattern in ASSOCIATED_PATTERN
+        ):
+            files.append([os.path.join(directory, name), new_stem + suffix])
+    return files
+
+
+@timing.timed("associated move")
 def associated_rename(scene_info: dict):
-    if ASSOCIATED_EXT:
-        for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info["current_path"])[0] + "." + ext
-            p_new = os.path.splitext(scene_info["final_path"])[0] + "." + ext
-            if os.path.isfile(p):
-                try:
-                    shutil.move(p, p_new)
-                except Exception as err:
-                    log.LogError(
-                        f"Something prevents renaming this file '{p}' - err: {err}"
-                    )
-                    continue
-            if os.path.isfile(p_new):
-                log.LogInfo(f"[OS] Associate file renamed ({p_new})")
-                if LOGFILE:
-                    try:
-                        with open(LOGFILE, "a", encoding="utf-8") as f:
-                            f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
-                    except Exception as err:
-                        shutil.move(p_new, p)
-                        log.LogError(
-                            f"Restoring the original name, error writing the logfile: {err}"
-                        )
+    # a plan already has the list of files
+    files = scene_info.get("associated")
+    if files is None:
+        files = associated_files(scene_info)
+    for p, p_new in files:
+        try:
+            mover.move_file(p, p_new)
+        except FileNotFoundError:
+            # removed since the directory was listed
+            continue
+        except Exception as err:
+            log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
+            continue
+        listing_moved(p, p_new)
+        log.LogInfo(f"[OS] Associate file renamed ({p_new})")
+        if LOGFILE:
+            try:
+                with open(LOGFILE, "a", encoding="utf-8") as f:
+                    f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
+            except Exception as err:
+                mover.move_file(p_new, p)
+                listing_moved(p_new, p)
+                log.LogError(
+                    f"Restoring the original name, error writing the logfile: {err}"
+                )
 
 
-def renamer(scene_id, db_conn=None):
+def renamer(scene_id, db_conn=None, db_batch=None, executor=None, plan=None):
     option_dryrun = False
     if type(scene_id) is dict:
         stash_scene = scene_id
@@ -1247,10 +1660,15 @@ def renamer(scene_id, db_conn=None):
     else:
         scene_files = []
     stash_db = None
+    # the templates and the information of the scene are the same for all its
+    # files, only the path templates can depend on the file.
+    filename_template = get_template_filename(stash_scene)
+    path_template = None
+    scene_parts = {}
     for i in range(0, len(scene_files)):
         scene_file = scene_files[i]
         # refractor file support
-        for f in scene_file["fingerprints"]:
+        for f in scene_file.get("fingerprints", []):
             if f.get("oshash"):
                 stash_scene["oshash"] = f["oshash"]
             if f.get("md5"):
@@ -1266,8 +1684,11 @@ def renamer(scene_id, db_conn=None):
 
         # Tags > Studios > Default
         template = {}
-        template["filename"] = get_template_filename(stash_scene)
-        template["path"] = get_template_path(stash_scene)
+        template["filename"] = filename_template
+        if path_template is None or config.p_path_templates:
+            path_template = get_template_path(stash_scene)
+        # extract_info edits the destination (^*)
+        template["path"] = dict(path_template)
         if not template["path"].get("destination"):
             if config.p_use_default_template:
                 log.LogDebug("[PATH] Using default template")
@@ -1292,42 +1713,20 @@ def renamer(scene_id, db_conn=None):
             return
 
         # log.LogDebug("Using this template: {}".format(filename_template))
-        scene_information = extract_info(stash_scene, template)
+        options = tuple(template["path"]["option"]) if template["path"] else ()
+        if options not in scene_parts:
+            scene_parts[options] = extract_scene_info(stash_scene, template)
+        scene_information = extract_file_info(
+            stash_scene, template, scene_parts[options]
+        )
         log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
         log.LogDebug(f"[{scene_id}] Template: {template}")
 
         scene_information["scene_id"] = scene_id
         scene_information["file_index"] = i
+        scene_information["file_id"] = scene_file.get("id")
 
-        for removed_field in ORDER_SHORTFIELD:
-            if removed_field:
-                if scene_information.get(removed_field.replace("$", "")):
-                    del scene_information[removed_field.replace("$", "")]
-                    log.LogWarning(f"removed {removed_field} to reduce the length path")
-                else:
-                    continue
-            if template["filename"]:
-                scene_information["new_filename"] = create_new_filename(
-                    scene_information, template["filename"]
-                )
-            else:
-                scene_information["new_filename"] = scene_information[
-                    "current_filename"
-                ]
-            if template.get("path"):
-                scene_information["new_directory"] = create_new_path(
-                    scene_information, template
-                )
-            else:
-                scene_information["new_directory"] = scene_information[
-                    "current_directory"
-                ]
-            scene_information["final_path"] = os.path.join(
-                scene_information["new_directory"], scene_information["new_filename"]
-            )
-            # check length of path
-            if IGNORE_PATH_LENGTH or len(scene_information["final_path"]) <= 240:
-                break
+        fit_path_length(scene_information, template)
 
         if check_longpath(scene_information["final_path"]):
             if (DRY_RUN or option_dryrun) and LOGFILE:
@@ -1340,8 +1739,16 @@ def renamer(scene_id, db_conn=None):
         # log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
         # log.LogDebug(f"Path: {scene_information['current_directory']} -> {scene_information['new_directory']}")
 
+        clean_tag = None
+        if template.get("path"):
+            if "clean_tag" in template["path"]["option"]:
+                clean_tag = template["path"]["opt_details"]["clean_tag"]
+
         if scene_information["final_path"] == scene_information["current_path"]:
             log.LogInfo(f"Everything is ok. ({scene_information['current_filename']})")
+            # the tags are left if their removal failed after the rename
+            if clean_tag and not (DRY_RUN or option_dryrun or plan):
+                remove_clean_tag(scene_information["scene_id"], clean_tag)
             continue
 
         if scene_information["current_directory"] != scene_information["new_directory"]:
@@ -1360,7 +1767,7 @@ def renamer(scene_id, db_conn=None):
                 log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
                 log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
 
-        if (DRY_RUN or option_dryrun) and LOGFILE:
+        if ((DRY_RUN and not plan) or option_dryrun) and LOGFILE:
             with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
                 f.write(
                     f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n"
@@ -1383,6 +1790,9 @@ def renamer(scene_id, db_conn=None):
         # abort
         if err:
             raise Exception("duplicate")
+        if plan:
+            plan_write(plan, scene_information, i == 0, clean_tag)
+            continue
         # connect to the db
         if not db_conn:
             stash_db = connect_db(STASH_DATABASE)
@@ -1391,55 +1801,417 @@ def renamer(scene_id, db_conn=None):
         else:
             stash_db = db_conn
         try:
-            # rename file on your disk
+            start_rename(
+                scene_information, i == 0, clean_tag, stash_db, db_batch, executor
+            )
+        except Exception as err:
+            log.LogError(f"Error during database operation ({err})")
+            if not db_conn:
+                log.LogDebug("[SQLITE] Database closed")
+                stash_db.close()
+            continue
+    if not db_conn and stash_db:
+        stash_db.close()
+        log.LogInfo("[SQLITE] Database updated and closed!")
+
+
+def start_rename(
+    scene_information: dict,
+    rename_associated: bool,
+    clean_tag,
+    stash_db: sqlite3.Connection,
+    db_batch=None,
+    executor=None,
+):
+    if PATH_INDEX.loaded:
+        PATH_INDEX.reserve(
+            scene_information["current_path"], scene_information["final_path"]
+        )
+    db_release = db_batch.release if db_batch else None
+    if executor:
+        # moves on the same drives are done one after the other
+        group = (
+            mover.device(scene_information["current_path"]),
+            mover.device(scene_information["new_directory"]),
+        )
+        db_write = functools.partial(executor.write, db_update, stash_db, db_batch)
+        if db_release:
+            db_release = functools.partial(executor.write, db_release)
+        executor.submit(
+            group,
+            apply_rename,
+            scene_information,
+            rename_associated,
+            clean_tag,
+            db_write,
+            db_release,
+        )
+        return
+    db_write = functools.partial(db_update, stash_db, db_batch)
+    apply_rename(scene_information, rename_associated, clean_tag, db_write, db_release)
+
+
+def apply_rename(
+    scene_information: dict,
+    rename_associated: bool,
+    clean_tag,
+    db_write,
+    db_release=None,
+):
+    if db_release:
+        # Stash can't write in its database while the batch is open, don't keep
+        # it open during a copy to another drive.
+        db_release(
+            mover.device(scene_information["current_path"])
+            != mover.device(scene_information["new_directory"])
+        )
+    try:
+        # rename file on your disk
+        err = file_rename(
+            scene_information["current_path"],
+            scene_information["final_path"],
+            scene_information,
+        )
+        if err:
+            raise Exception("rename")
+        # rename file on your db
+        try:
+            db_write(scene_information)
+        except Exception as err:
+            log.LogError(
+                f"error when trying to update the database ({err}), revert the move..."
+            )
             err = file_rename(
-                scene_information["current_path"],
                 scene_information["final_path"],
+                scene_information["current_path"],
                 scene_information,
             )
             if err:
                 raise Exception("rename")
-            # rename file on your db
+            raise Exception("database update")
+    except Exception:
+        if PATH_INDEX.loaded:
+            PATH_INDEX.release(scene_information["final_path"])
+        raise
+    if PATH_INDEX.loaded:
+        PATH_INDEX.release(scene_information["current_path"])
+    if rename_associated:
+        associated_rename(scene_information)
+    if clean_tag:
+        remove_clean_tag(scene_information["scene_id"], clean_tag)
+
+
+def remove_clean_tag(scene_id, tag_ids: list):
+    if TAG_REMOVALS is None:
+        graphql_removeScenesTag([scene_id], tag_ids)
+    else:
+        queue_tag_removal(scene_id, tag_ids)
+
+
+def queue_tag_removal(scene_id, tag_ids: list):
+    """The task renamer removes the tags of many scenes with one bulkSceneUpdate."""
+    with TAG_REMOVALS_LOCK:
+        TAG_REMOVALS.setdefault(tuple(sorted(tag_ids)), []).append(scene_id)
+
+
+def flush_tag_removals(db_batch=None):
+    # Stash writes the tags in its database, the renames of the batch must be
+    # committed before or it would wait for us.
+    if db_batch:
+        db_batch.commit()
+    with TAG_REMOVALS_LOCK:
+        removals = list(TAG_REMOVALS.items())
+        TAG_REMOVALS.clear()
+    done = True
+    for tag_ids, scenes in removals:
+        for i in range(0, len(scenes), TAG_REMOVAL_BATCH):
+            batch = scenes[i : i + TAG_REMOVAL_BATCH]
             try:
-                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-                    db_rename_refactor(stash_db, scene_information)
-                else:
-                    db_rename(stash_db, scene_information)
+                # a GraphQL error comes back without data
+                if not graphql_removeScenesTag(batch, list(tag_ids)):
+                    raise Exception("no scene updated")
             except Exception as err:
                 log.LogError(
-                    f"error when trying to update the database ({err}), revert the move..."
+                    f"Failed to remove the tags {list(tag_ids)} of {len(batch)} scenes ({err})"
                 )
-                err = file_rename(
-                    scene_information["final_path"],
-                    scene_information["current_path"],
+                done = False
+            else:
+                log.LogDebug(f"Removed the tags {list(tag_ids)} of {len(batch)} scenes")
+    return done
+
+
+def plan_write(plan, scene_information: dict, rename_associated: bool, clean_tag):
+    associated = []
+    if rename_associated:
+        associated = associated_files(scene_information)
+    entry = {
+        "scene_id": scene_information["scene_id"],
+        "file_id": scene_information["file_id"],
+        "old_path": scene_information["current_path"],
+        "new_path": scene_information["final_path"],
+        "associated": associated,
+        "clean_tag": clean_tag,
+        "oshash": scene_information["oshash"],
+    }
+    plan.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    # the next scenes are planned as if this one was renamed
+    PATH_INDEX.reserve(
+        scene_information["current_path"], scene_information["final_path"]
+    )
+    PATH_INDEX.release(scene_information["current_path"])
+
+
+def db_update(stash_db: sqlite3.Connection, db_batch, scene_info: dict):
+    if db_batch:
+        db_batch.rename_file(scene_info)
+    elif DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        db_rename_refactor(stash_db, scene_info)
+    else:
+        db_rename(stash_db, scene_info)
+
+
+def bulk_renamer(stash_db: sqlite3.Connection, incremental=False):
+    """Rename every scene, or with `incremental` the ones updated since the last run."""
+    load_studio_cache()
+    PATH_INDEX.load(stash_db, DB_VERSION >= DB_VERSION_FILE_REFACTOR)
+    db_batch = None
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        db_batch = database.RenameBatch(
+            stash_db, DB_BATCH_SIZE, DB_WAL, DB_BATCH_SECONDS
+        )
+    executor = None
+    if BULK_WORKERS > 1:
+        executor = parallel.RenameExecutor(BULK_WORKERS)
+    if incremental:
+        watermark = watermark_load()
+        if watermark:
+            log.LogInfo(f"Checking the scenes updated after {watermark}")
+        pages = graphql_findScene_updated_pages(BULK_PAGE_SIZE, watermark)
+    else:
+        last_id = checkpoint_load()
+        if last_id:
+            log.LogInfo(f"Resuming from the checkpoint (scenes after id {last_id})")
+        pages = graphql_findScene_pages(BULK_PAGE_SIZE, last_id)
+    limit = config.batch_number_scene
+    total = None
+    done = 0
+    flushed = True
+    try:
+        for scenes in pages:
+            OPEN_FILES.clear()
+            DIR_LISTING.clear()
+            if total is None:
+                total = scenes["count"]
+                if 0 < limit < total:
+                    total = limit
+                log.LogDebug(f"Count scenes: {total}")
+            for scene in scenes["scenes"]:
+                log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+                try:
+                    renamer(scene, stash_db, db_batch, executor)
+                except Exception as err:
+                    log.LogError(f"main function error: {err}")
+                done += 1
+                log.LogProgress(done / total)
+                if done == limit:
+                    break
+            if executor:
+                # the moves of the page have to be done before saving the checkpoint
+                executor.wait()
+            # the checkpoint is saved once per page (a stopped run checks the
+            # scenes of its last page again). It and the watermark wait for the
+            # tags of the page to be removed, after a failure they stay where
+            # they are for the rest of the run and the next one removes the
+            # tags left.
+            if TAG_REMOVALS:
+                flushed = flush_tag_removals(db_batch) and flushed
+            if flushed and not incremental:
+                checkpoint_save(scene["id"])
+            # a page stopped by the limit keeps the previous watermark, its
+            # scenes are checked again by the next run.
+            if flushed and incremental and done != limit:
+                watermark_save(scenes["watermark"])
+            if done == limit:
+                log.LogInfo(f"Stopped after {done} scenes (batch_number_scene)")
+                return
+    finally:
+        if executor:
+            executor.shutdown()
+        if TAG_REMOVALS:
+            flush_tag_removals(db_batch)
+        if VACATED_FOLDERS:
+            remove_empty_folders(db_batch)
+        # the files are already moved, save what is left in the batch.
+        if db_batch:
+            db_batch.commit()
+    # every scene has been checked, the next run starts from the beginning.
+    if not DRY_RUN and not incremental:
+        checkpoint_clear()
+
+
+def plan_renamer(stash_db: sqlite3.Connection):
+    load_studio_cache()
+    PATH_INDEX.load(stash_db, DB_VERSION >= DB_VERSION_FILE_REFACTOR)
+    total = None
+    done = 0
+    with open(f"{PLAN_FILE}.tmp", "w", encoding="utf-8") as plan:
+        for scenes in graphql_findScene_pages(BULK_PAGE_SIZE):
+            DIR_LISTING.clear()
+            if total is None:
+                total = scenes["count"]
+                log.LogDebug(f"Count scenes: {total}")
+            for scene in scenes["scenes"]:
+                log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+                try:
+                    renamer(scene, stash_db, plan=plan)
+                except Exception as err:
+                    log.LogError(f"main function error: {err}")
+                done += 1
+                log.LogProgress(done / total)
+        planned = plan.tell()
+    os.replace(f"{PLAN_FILE}.tmp", PLAN_FILE)
+    if planned:
+        log.LogInfo(f"Plan saved, run 'Apply plan' to rename the files ({PLAN_FILE})")
+    else:
+        log.LogInfo("Nothing to rename")
+
+
+def apply_plan(stash_db: sqlite3.Connection):
+    if not os.path.isfile(PLAN_FILE):
+        log.LogError("No plan to apply, run the 'Plan' task first")
+        return
+    with open(PLAN_FILE, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    PATH_INDEX.load(stash_db, DB_VERSION >= DB_VERSION_FILE_REFACTOR)
+    db_batch = None
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        db_batch = database.RenameBatch(
+            stash_db, DB_BATCH_SIZE, DB_WAL, DB_BATCH_SECONDS
+        )
+    executor = None
+    if BULK_WORKERS > 1:
+        executor = parallel.RenameExecutor(BULK_WORKERS)
+    try:
+        for done, entry in enumerate(entries, 1):
+            scene_information = {
+                "scene_id": entry["scene_id"],
+                "file_id": entry["file_id"],
+                "oshash": entry["oshash"],
+                "current_path": entry["old_path"],
+                "current_directory": os.path.dirname(entry["old_path"]),
+                "current_filename": os.path.basename(entry["old_path"]),
+                "final_path": entry["new_path"],
+                "new_directory": os.path.dirname(entry["new_path"]),
+                "new_filename": os.path.basename(entry["new_path"]),
+                "associated": entry["associated"],
+            }
+            if DRY_RUN:
+                if LOGFILE:
+                    with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
+                        f.write(
+                            f"{entry['scene_id']}|{entry['old_path']}|{entry['new_path']}\n"
+                        )
+                continue
+            log.LogDebug(
+                f"[{entry['scene_id']}] {entry['old_path']} -> {entry['new_path']}"
+            )
+            try:
+                # the library could have changed since the plan was made
+                if checking_duplicate_index(scene_information):
+                    raise Exception("duplicate")
+                start_rename(
                     scene_information,
+                    True,
+                    entry["clean_tag"],
+                    stash_db,
+                    db_batch,
+                    executor,
                 )
-                if err:
-                    raise Exception("rename")
-                raise Exception("database update")
-            if i == 0:
-                associated_rename(scene_information)
-            if template.get("path"):
-                if "clean_tag" in template["path"]["option"]:
-                    graphql_removeScenesTag(
-                        [scene_information["scene_id"]],
-                        template["path"]["opt_details"]["clean_tag"],
-                    )
+            except Exception as err:
+                log.LogError(f"[{entry['scene_id']}] Error during the rename ({err})")
+            log.LogProgress(done / len(entries))
+    finally:
+        if executor:
+            executor.shutdown()
+        if TAG_REMOVALS:
+            flush_tag_removals(db_batch)
+        if VACATED_FOLDERS:
+            remove_empty_folders(db_batch)
+        if db_batch:
+            db_batch.commit()
+
+
+def worker_renamer():
+    log.LogDebug("--Starting Worker 'Renamer'--")
+    # a changed config or plugin needs a new worker to be taken into account
+    watched = [config.__file__, os.path.abspath(__file__)]
+    mtimes = [os.path.getmtime(f) for f in watched]
+    server = worker.listen(config_option("hook_worker_port"))
+    if server is None:
+        log.LogDebug("A worker is already running")
+        return
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        server.close()
+        return
+    # the hooks read it from the state file, only they can give jobs
+    token = secrets.token_hex(16)
+    STATE.set("worker_token", token)
+
+    def job(scene):
+        if [os.path.getmtime(f) for f in watched] != mtimes:
+            return {"restart": True}
+        # the session can change if Stash has been restarted
+        FRAGMENT_SERVER.update(scene["server_connection"])
+        # the dry-run task could have been used since the last update
+        STATE.load()
+        global DRY_RUN
+        DRY_RUN = STATE.get("dry_run", config.dry_run)
+        # studios could have been edited since the last update
+        STUDIO_CACHE.clear()
+        OPEN_FILES.clear()
+        DIR_LISTING.clear()
+        job_start = time.time()
+        log.LogDebug("--Starting Hook 'Renamer' (worker)--")
+        if DRY_RUN and DRY_RUN_FILE and not config.dry_run_append:
+            if os.path.exists(DRY_RUN_FILE):
+                os.remove(DRY_RUN_FILE)
+        try:
+            renamer(scene["scene_id"], stash_db)
         except Exception as err:
-            log.LogError(f"Error during database operation ({err})")
-            if not db_conn:
-                log.LogDebug("[SQLITE] Database closed")
-                stash_db.close()
-            continue
-    if not db_conn and stash_db:
-        stash_db.close()
-        log.LogInfo("[SQLITE] Database updated and closed!")
+            log.LogError(f"main function error: {err}")
+            traceback.print_exc()
+        log.LogDebug(f"Execution time: {round(time.time() - job_start, 5)}s")
+        return {"output": "Successful!", "error": None}
+
+    worker.serve(
+        server,
+        job,
+        config_option("hook_worker_idle_timeout"),
+        token,
+        config_option("hook_quiet_window"),
+    )
+    stash_db.close()
+    log.LogDebug("[SQLITE] Database closed")
 
 
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
+    if GRAPHQL_STATS["count"]:
+        log.LogDebug(
+            f"GraphQL: {GRAPHQL_STATS['count']} requests in {round(GRAPHQL_STATS['time'], 5)}s "
+            f"(avg {round(GRAPHQL_STATS['time'] / GRAPHQL_STATS['count'] * 1000, 2)}ms)"
+        )
+    # save what has been built from config.py for the next run
+    if CONFIG_CACHE is not None and len(TEMPLATE_CACHE) != CONFIG_CACHE_SIZE:
+        state.save_cache(CONFIG_CACHE_FILE, CONFIG_CACHE_KEY, CONFIG_CACHE)
+    log_normalization_cache()
     log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
+    if timing.ENABLED:
+        timing.report(time.time() - START_TIME)
+        if config_option("timing_dump"):
+            timing.dump(config_option("timing_dump"), time.time() - START_TIME)
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
     sys.exit()
@@ -1447,25 +2219,25 @@ def exit_plugin(msg=None, err=None):
 
 if PLUGIN_ARGS:
     log.LogDebug("--Starting Plugin 'Renamer'--")
-    if "bulk" not in PLUGIN_ARGS:
+    if PLUGIN_ARGS not in ("bulk", "incremental", "worker", "plan", "apply"):
         if "enable" in PLUGIN_ARGS:
             log.LogInfo("Enable hook")
-            success = config_edit("enable_hook", True)
+            success = STATE.set("enable_hook", True)
         elif "disable" in PLUGIN_ARGS:
             log.LogInfo("Disable hook")
-            success = config_edit("enable_hook", False)
+            success = STATE.set("enable_hook", False)
         elif "dryrun" in PLUGIN_ARGS:
-            if config.dry_run:
+            if DRY_RUN:
                 log.LogInfo("Disable dryrun")
-                success = config_edit("dry_run", False)
+                success = STATE.set("dry_run", False)
             else:
                 log.LogInfo("Enable dryrun")
-                success = config_edit("dry_run", True)
+                success = STATE.set("dry_run", True)
         if not success:
             log.LogError("Script failed to change the value")
         exit_plugin("script finished")
 else:
-    if not config.enable_hook:
+    if not HOOK_ENABLED:
         exit_plugin("Hook disabled")
     log.LogDebug("--Starting Hook 'Renamer'--")
     FRAGMENT_HOOK_TYPE = FRAGMENT["args"]["hookContext"]["type"]
@@ -1477,12 +2249,16 @@ LOGFILE = config.log_file
 # if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
+GRAPHQL_URL = get_graphql_url()
+GRAPHQL_SESSION = create_graphql_session()
+
 STASH_CONFIG = graphql_getConfiguration()
 STASH_DATABASE = STASH_CONFIG["general"]["databasePath"]
 
 # READING CONFIG
 
 ASSOCIATED_EXT = config.associated_extension
+ASSOCIATED_PATTERN = config_option("associated_pattern")
 
 FIELD_WHITESPACE_SEP = config.field_whitespaceSeperator
 FIELD_REPLACER = config.field_replacer
@@ -1492,8 +2268,23 @@ FILENAME_LOWER = config.lowercase_Filename
 FILENAME_TITLECASE = config.titlecase_Filename
 FILENAME_SPLITCHAR = config.filename_splitchar
 FILENAME_REMOVECHARACTER = config.removecharac_Filename
+REMOVECHARACTER_REGEX = (
+    re.compile(f"[{FILENAME_REMOVECHARACTER}]+") if FILENAME_REMOVECHARACTER else None
+)
 FILENAME_REPLACEWORDS = config.replace_words
 
+# built from config.py, kept until it's modified
+CONFIG_CACHE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_cache.pickle")
+CONFIG_CACHE_KEY = state.files_key(config.__file__, template_engine.__file__)
+CONFIG_CACHE = state.load_cache(CONFIG_CACHE_FILE, CONFIG_CACHE_KEY)
+CONFIG_CACHE_SIZE = len(CONFIG_CACHE.get("templates", ())) if CONFIG_CACHE else -1
+TEMPLATE_CACHE = CONFIG_CACHE.setdefault("templates", {})
+if "replace_words" not in CONFIG_CACHE:
+    CONFIG_CACHE["replace_words"] = template_engine.compile_replace_words(
+        FILENAME_REPLACEWORDS
+    )
+REPLACE_WORDS_STAGES = CONFIG_CACHE["replace_words"]
+
 PERFORMER_SPLITCHAR = config.performer_splitchar
 PERFORMER_LIMIT = config.performer_limit
 PERFORMER_LIMIT_KEEP = config.performer_limit_keep
@@ -1518,77 +2309,78 @@ IGNORE_PATH_LENGTH = config.ignore_path_length
 
 PREVENT_CONSECUTIVE = config.prevent_consecutive
 REMOVE_EMPTY_FOLDER = config.remove_emptyfolder
+REMOVE_EMPTY_PARENTS = config_option("remove_emptyfolder_parents")
+# the task renamer removes the empty folders once, at the end
+VACATED_FOLDERS = None
+if REMOVE_EMPTY_FOLDER and PLUGIN_ARGS in ("bulk", "incremental", "apply"):
+    VACATED_FOLDERS = set()
+# the task renamer removes the clean_tag tags by batches of scenes, at the end of
+# each page and of the task.
+TAG_REMOVALS = None
+if PLUGIN_ARGS in ("bulk", "incremental", "apply"):
+    TAG_REMOVALS = {}
+TAG_REMOVALS_LOCK = threading.Lock()
+TAG_REMOVAL_BATCH = 500
+MOVE_VERIFY_HASH = config_option("move_verify_hash")
+# the task renamer shows the progress of the scenes, not of a copy
+MOVE_PROGRESS = (
+    None if PLUGIN_ARGS in ("bulk", "incremental", "apply") else log.LogProgress
+)
 
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
 UNICODE_USE = config.use_ascii
 
 ORDER_SHORTFIELD = config.order_field
-ORDER_SHORTFIELD.insert(0, None)
+TRUNCATE_FIELD = config_option("truncate_field")
+PATH_LENGTH_LIMIT = 240
 
 ALT_DIFF_DISPLAY = config.alt_diff_display
 
+OPEN_FILES = {}
+# directory -> names of its files, for the associated files
+DIR_LISTING = {}
+
+STUDIO_CACHE = {}
+PATH_INDEX = database.PathIndex()
+STUDIO_PAGE_SIZE = 1000
+
+BULK_PAGE_SIZE = config_option("bulk_page_size")
+BULK_CHECKPOINT = config_option("bulk_checkpoint")
+BULK_WORKERS = config_option("bulk_workers")
+PLAN_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl")
+DB_BATCH_SIZE = config_option("db_batch_size")
+DB_WAL = config_option("db_wal")
+DB_BATCH_SECONDS = config_option("db_batch_seconds")
+
 PATH_NOPERFORMER_FOLDER = config.path_noperformer_folder
 PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
 DB_VERSION = graphql_getBuild()
-if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-    FILE_QUERY = """
-            files {
-                path
-                video_codec
-                audio_codec
-                width
-                height
-                frame_rate
-                duration
-                bit_rate
-                phash: fingerprint(type: "phash")
-                oshash: fingerprint(type: "oshash")
-                checksum: fingerprint(type: "checksum")
-                fingerprints {
-                    type
-                    value
-                }
-            }
-    """
-else:
-    FILE_QUERY = """
-            path
-            file {
-                video_codec
-                audio_codec
-                width
-                height
-                framerate
-                bitrate
-                duration
-            }
-    """
-if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
-    FILE_QUERY = f"        code{FILE_QUERY}"
+SCENE_FIELDS = scene_fields()
 
 if PLUGIN_ARGS:
-    if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes["scenes"])
+    if PLUGIN_ARGS in ("bulk", "incremental"):
         stash_db = connect_db(STASH_DATABASE)
         if stash_db is None:
             exit_plugin()
-        for scene in scenes["scenes"]:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
-            try:
-                renamer(scene, stash_db)
-            except Exception as err:
-                log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
+        bulk_renamer(stash_db, PLUGIN_ARGS == "incremental")
+        stash_db.close()
+        log.LogInfo("[SQLITE] Database closed!")
+    elif PLUGIN_ARGS in ("plan", "apply"):
+        stash_db = connect_db(STASH_DATABASE)
+        if stash_db is None:
+            exit_plugin()
+        if PLUGIN_ARGS == "plan":
+            plan_renamer(stash_db)
+        else:
+            apply_plan(stash_db)
         stash_db.close()
         log.LogInfo("[SQLITE] Database closed!")
+    elif "worker" in PLUGIN_ARGS:
+        worker_renamer()
 else:
     try:
         renamer(FRAGMENT_SCENE_ID)
@@ -117,6 +117,9 @@ log_file = r""
 
 # rename associated file (subtitle, funscript) if present
 associated_extension = ["srt", "vtt", "funscript"]
+# also rename the files matching these patterns after the filename (without its extension).
+# e.g. ".*.srt" for 'name.en.srt', "-thumb.jpg" for 'name-thumb.jpg'. The directory is listed once for all the scenes in it.
+associated_pattern = []
 
 # use filename as title if no title is set
 # it will cause problem if you update multiple time the same scene without title.
@@ -183,6 +186,12 @@ prevent_title_performer = False
 prevent_consecutive = True
 # check when the file has moved that the old directory is empty, if empty it will remove it.
 remove_emptyfolder = True
+# with the tasks (Rename scenes, Apply plan), the emptied folders are removed at the end, the deepest first.
+# Also remove the parent folders that become empty, up to the library folder.
+remove_emptyfolder_parents = False
+# when the file is moved to another drive, it's copied then deleted. Compare the hash of the copy with the original (slower) before deleting it.
+# The size is always checked.
+move_verify_hash = False
 # the folder only contains 1 performer name. Else it will look the same as for filename
 path_one_performer = True
 # if there is no performer on the scene, the $performer field will be replaced by "NoPerformer" so a folder "NoPerformer" will be created
@@ -244,19 +253,59 @@ order_field = [
     "$performer",
 ]
 
+# Field cut (from the end) if the path is still too long after removing the fields above. e.g. ["$title"]
+truncate_field = []
+
 # Alternate way to show diff. Not useful at all.
 alt_diff_display = False
 
 # number of scene process by the task renamer. -1 = all scenes
 batch_number_scene = -1
-
-# disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
+# number of scenes requested at once by the task renamer, the next page is loaded while the current one is renamed.
+bulk_page_size = 500
+# save the last scene checked by the task renamer, an interrupted run (or a run stopped by batch_number_scene) continues from there.
+# The checkpoint (in renamerOnUpdate_state.json) is removed once every scene has been checked. Not used in dry-run.
+bulk_checkpoint = True
+# number of files moved at the same time by the task renamer, when they are on different drives. 1 = one file after the other.
+# The moves between the same drives are always done one after the other.
+bulk_workers = 1
+# number of renamed files saved at once in the database by the task renamer. A lower number locks the database for a shorter time.
+db_batch_size = 100
+# they are also saved when the first one is older than this (seconds), and before a file is copied to another drive.
+db_batch_seconds = 1
+# switch the database to WAL mode before the task renamer, so Stash can still read it while files are renamed.
+db_wal = False
+
+# disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash (saved in renamerOnUpdate_state.json, it replaces this one).
 enable_hook = True
 # disable/enable dry mode. Do a trial run with no permanent changes. Can write into a file (dryrun_renamerOnUpdate.txt), set a path for log_file.
-# You can edit this value in 'Plugin Tasks' inside of Stash.
+# You can edit this value in 'Plugin Tasks' inside of Stash (saved in renamerOnUpdate_state.json, it replaces this one).
 dry_run = False
 # Choose if you want to append to (True) or overwrite (False) the dry-run log file.
 dry_run_append = True
+# Keep a worker running in the background for the hook. The first update starts it, the next ones are handed to it
+# so the config, Stash information and database connection are not loaded again for every update.
+# The worker restarts by itself when config.py is edited.
+hook_worker = False
+# Local port (127.0.0.1) used to talk to the worker.
+hook_worker_port = 47621
+# The worker stops after this many seconds without update.
+hook_worker_idle_timeout = 600
+# Wait this many seconds without another update of the scene before renaming it (0 = rename at once).
+# Identify/scrape can update the same scene several times in a row (tags, performers, studio...), it's renamed once, after the last one.
+# Needs hook_worker.
+hook_quiet_window = 0
+# Connections kept open to Stash (useful when the next page of scenes is loaded during a rename).
+graphql_pool_size = 10
+# Retry a request to Stash this many times if the connection fails, waiting longer each time (backoff in seconds).
+graphql_retries = 3
+graphql_backoff = 0.5
+# Seconds to wait for an answer from Stash.
+graphql_timeout = 20
+# log a table of the time spent in each stage (GraphQL queries, rendering, duplicate check, moves, sqlite...) at the end of the run.
+timing = False
+# with timing, also write it to this file: a path ending with '.prof' saves a cProfile dump of the run (pstats, snakeviz), else a JSON of the stages.
+timing_dump = ""
 ######################################
 #            Module Related          #
 
@@ -0,0 +1,90 @@
+import json
+import os
+import pickle
+
+import log
+
+# StateStore: what the plugin changes itself (hook enabled, dry-run, where the
+# tasks stopped) is kept in a small JSON file next to the plugin, config.py is
+# never rewritten.
+# load_cache/save_cache: what is built from config.py (replace_words stages,
+# templates) is pickled and reused while config.py isn't modified.
+
+
+class StateStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.values = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                self.values = json.load(f)
+        except FileNotFoundError:
+            self.values = {}
+        except (OSError, ValueError) as err:
+            log.LogWarning(f"Ignoring unreadable state file ({err})")
+            self.values = {}
+
+    def get(self, key: str, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key: str, value):
+        # another process (the worker, a task) could have saved since the load
+        self.load()
+        self.values[key] = value
+        return self.save()
+
+    def delete(self, key: str):
+        self.load()
+        if self.values.pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        # write then replace, a killed run never leaves a half written file
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf8") as f:
+                json.dump(self.values, f)
+            os.replace(tmp_file, self.path)
+        except OSError as err:
+            log.LogWarning(f"Failed to save the state ({err})")
+            return False
+        return True
+
+
+def files_key(*paths):
+    """Changes when one of the files is modified."""
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            key.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            key.append((path, None, None))
+    return key
+
+
+def load_cache(path: str, key) -> dict:
+    """The values saved with the same key, else an empty dict."""
+    try:
+        with open(path, "rb") as f:
+            cache = pickle.load(f)
+        if cache["key"] == key:
+            return cache["values"]
+    except FileNotFoundError:
+        pass
+    except Exception as err:
+        log.LogDebug(f"Ignoring the config cache ({err})")
+    return {}
+
+
+def save_cache(path: str, key, values: dict):
+    tmp_file = f"{path}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            pickle.dump({"key": key, "values": values}, f)
+        os.replace(tmp_file, path)
+    except (OSError, pickle.PicklingError) as err:
+        log.LogDebug(f"Failed to save the config cache ({err})")
@@ -0,0 +1,260 @@
+import re
+from functools import lru_cache
+
+import log
+
+# Templates ($date $performer - $title...) are parsed once by compile_template,
+# render_template then only has to fill the fields for each scene.
+
+FIELD_REGEX = re.compile(r"\$\w+")
+EMPTY_GROUP_REGEX = re.compile(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}")
+BRACES_REGEX = re.compile(r"[{}]")
+CONSECUTIVE_NONWORD_REGEX = re.compile(r"(\W+)\1+")
+NONWORD_RUN_REGEX = re.compile(r"\W{2,}")
+
+
+def compile_template(text: str, field_replacer: dict, prevent_title_performer: bool):
+    field_found = FIELD_REGEX.findall(text)
+    # longest first, so $studio doesn't replace the start of $studio_family
+    field_found.sort(key=len, reverse=True)
+    steps = []
+    for i, field in enumerate(field_found):
+        name = field.replace("$", "").strip("_")
+        # If $performer is before $title, prevent having duplicate text.
+        check_title = (
+            name == "performer"
+            and prevent_title_performer
+            and len(field_found) > i + 1
+            and field_found[i + 1] == "$title"
+        )
+        steps.append((field, name, check_title, field_replacer.get(f"${name}")))
+    return {"text": text, "steps": steps}
+
+
+def render_template(template: dict, scene_information: dict):
+    result = template["text"]
+    title = None
+    for field, name, check_title, replacer in template["steps"]:
+        if (
+            check_title
+            and scene_information.get("performer")
+            and scene_information.get("title")
+        ):
+            if re.search(
+                f"^{scene_information['performer'].lower()}",
+                scene_information["title"].lower(),
+            ):
+                log.LogDebug(
+                    "Ignoring the performer field because it's already in start of title"
+                )
+                result = result.replace("$performer", "")
+                continue
+        replaced_word = scene_information.get(name)
+        if not replaced_word:
+            replaced_word = ""
+        if replacer:
+            replaced_word = replaced_word.replace(replacer["replace"], replacer["with"])
+        if name == "title":
+            title = replaced_word.strip()
+            continue
+        if replaced_word == "":
+            result = result.replace(field, replaced_word)
+        else:
+            result = result.replace(f"${name}", replaced_word)
+    return result, title
+
+
+def cleanup_text(text: str):
+    text = EMPTY_GROUP_REGEX.sub("", text)
+    text = BRACES_REGEX.sub("", text)
+    text = remove_consecutive_nonword(text)
+    return text.strip(" -_.")
+
+
+def remove_consecutive_nonword(text: str):
+    # A repetition only contains non-word characters, so it can't go past a run
+    # of them. The runs (" - ", "] [", ...) are few and repeat a lot between
+    # filenames, each one is only collapsed once.
+    return NONWORD_RUN_REGEX.sub(collapse_nonword_run, text)
+
+
+def collapse_nonword_run(match: re.Match):
+    return _collapse_nonword_run(match.group())
+
+
+@lru_cache(maxsize=4096)
+def _collapse_nonword_run(run: str):
+    for _ in range(0, 10):
+        run, found = CONSECUTIVE_NONWORD_REGEX.subn(r"\1", run)
+        if not found:
+            break
+    return run
+
+
+# --- replace_words ---------------------------------------------------------------
+# The rules of config.replace_words are applied one after the other. Consecutive
+# 'word'/'any' rules that can't affect each other are merged in one regex (a trie
+# of the words) with a dict to find the replacement, so the filename is scanned
+# once for all of them. A rule that could interact with the previous ones starts
+# a new stage, the result is the same as applying every rule in order.
+
+SEPARATOR_REGEX = re.compile(r"[\s_-]")
+
+
+def compile_replace_words(replace_words: dict):
+    stages = []
+    group = []
+    for old, new in replace_words.items():
+        if type(new) is str:
+            new = [new]
+        system = new[1] if len(new) > 1 else "word"
+        if system not in ("word", "any", "regex"):
+            log.LogWarning(f"replace_words: unknown system '{system}' for '{old}'")
+            continue
+        rule = (old, new[0], system)
+        if _mergeable(rule) and _fits_group(group, rule):
+            group.append(rule)
+            continue
+        if group:
+            stages.append(_make_stage(group))
+        if _mergeable(rule):
+            group = [rule]
+        else:
+            group = []
+            stages.append(_make_stage([rule]))
+    if group:
+        stages.append(_make_stage(group))
+    return stages
+
+
+def replace_words(stages: list, text: str):
+    for kind, pattern, rules in stages:
+        if kind == "regex":
+            old, new, _ = rules[0]
+            tmp = pattern.sub(new, text)
+            if tmp != text:
+                log.LogDebug(f"Regex matched: {text} -> {tmp}")
+        elif kind == "single":
+            old, new, system = rules[0]
+            if system == "any":
+                tmp = text.replace(old, new)
+            else:
+                tmp = pattern.sub(f"\\1{new}\\3", text)
+            if tmp != text:
+                log.LogDebug(f"'{old}' changed with '{new}'")
+        else:
+            changed = set()
+            tmp = pattern.sub(_merged_replacer(rules, changed), text)
+            for old, new, _ in rules.values():
+                if old in changed:
+                    log.LogDebug(f"'{old}' changed with '{new}'")
+        text = tmp
+    return text
+
+
+def _mergeable(rule):
+    old, new, system = rule
+    if not old or system == "regex":
+        return False
+    if system == "word":
+        # the word is used as a regex and the replacement as a template
+        return re.escape(old) == old and "\\" not in new
+    return True
+
+
+def _fits_group(group: list, rule):
+    old, _, system = rule
+    words = system == "word" or any(r[2] == "word" for r in group)
+    # separators around a word must not be touched by another rule
+    if words and any(SEPARATOR_REGEX.search(r[0]) for r in group + [rule]):
+        return False
+    return all(_independent(r, rule) for r in group)
+
+
+def _independent(before, after):
+    old_b, new_b, system_b = before
+    old_a, _, system_a = after
+    # the matches can't overlap
+    if _overlap(old_b, old_a) or _overlap(old_a, old_b):
+        return False
+    # the first replacement can't create a match for the second rule
+    if not new_b:
+        # removing a term joins the text around it
+        return system_b == "word"
+    if _overlap(new_b, old_a) or _overlap(old_a, new_b):
+        return False
+    if system_a == "word" and (
+        SEPARATOR_REGEX.match(new_b[0]) or SEPARATOR_REGEX.match(new_b[-1])
+    ):
+        return False
+    return True
+
+
+def _overlap(a: str, b: str):
+    # b inside a, or the end of a is the start of b
+    if b[0] not in a:
+        return False
+    if b in a:
+        return True
+    return any(a.endswith(b[:k]) for k in range(1, min(len(a), len(b))))
+
+
+def _trie_regex(words: list):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(c) + build(child) for c, child in node.items() if c]
+        if "" in node:
+            branches.append("")
+        if len(branches) == 1:
+            return branches[0]
+        return f"(?:{'|'.join(branches)})"
+
+    return build(trie)
+
+
+def _make_stage(group: list):
+    old, _, system = group[0]
+    if system == "regex":
+        return ("regex", re.compile(old), group)
+    if len(group) == 1:
+        if system == "any":
+            return ("single", None, group)
+        return ("single", re.compile(rf"([\s_-])({old})([\s_-])"), group)
+    words = [r[0] for r in group if r[2] == "word"]
+    terms = [r[0] for r in group if r[2] == "any"]
+    branches = []
+    if words:
+        # starts with the separator, cheaper to look for than a lookbehind
+        branches.append(rf"([\s_-])({_trie_regex(words)})(?=[\s_-])")
+    if terms:
+        branches.append(_trie_regex(terms))
+    return ("merged", re.compile("|".join(branches)), {r[0]: r for r in group})
+
+
+def _merged_replacer(rules: dict, changed: set):
+    # A 'word' rule takes the separator after the word: the same word right after
+    # (" foo foo ") isn't replaced, like re.sub would do for this rule alone.
+    consumed = {}
+
+    def replace(match: re.Match):
+        separator = ""
+        if match.lastindex is None:
+            # an 'any' term
+            old, new, _ = rules[match.group()]
+        else:
+            separator = match.group(1)
+            old, new, _ = rules[match.group(2)]
+            if consumed.get(old, 0) > match.start():
+                return match.group()
+            consumed[old] = match.end() + 1
+        if new != old:
+            changed.add(old)
+        return separator + new
+
+    return replace
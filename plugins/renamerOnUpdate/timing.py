@@ -0,0 +1,88 @@
+import cProfile
+import functools
+import json
+import threading
+import time
+
+import log
+
+# Opt-in timing of the stages of a run (config.timing). Each stage adds its wall
+# time and its number of calls, the table is logged at exit. The renames can run
+# in other threads (bulk_workers), so the stages are added under a lock.
+# Stages can be nested (a move includes the handle hunt), they don't add up to
+# the execution time.
+
+ENABLED = False
+STAGES = {}
+LOCK = threading.Lock()
+PROFILER = None
+
+
+def enable(profile=False):
+    """Start recording. With `profile`, the main thread also runs under cProfile."""
+    global ENABLED, PROFILER
+    ENABLED = True
+    if profile:
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
+
+
+def add(name: str, elapsed: float):
+    with LOCK:
+        stage = STAGES.setdefault(name, [0, 0.0])
+        stage[0] += 1
+        stage[1] += elapsed
+
+
+def timed(name: str):
+    """Decorator, every call of the function is added to the stage `name`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                add(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def report(total: float):
+    if not STAGES:
+        return
+    log.LogInfo(f"{'Stage':<32}{'Calls':>8}{'Total (s)':>12}{'Avg (ms)':>12}{'%':>7}")
+    with LOCK:
+        stages = sorted(STAGES.items(), key=lambda s: s[1][1], reverse=True)
+    for name, (calls, elapsed) in stages:
+        log.LogInfo(
+            f"{name:<32}{calls:>8}{elapsed:>12.4f}{elapsed / calls * 1000:>12.3f}"
+            f"{elapsed / total * 100 if total else 0:>7.1f}"
+        )
+    log.LogInfo(f"{'Execution time':<32}{'':>8}{total:>12.4f}")
+
+
+def dump(path: str, total: float):
+    """'.prof' writes the cProfile stats (pstats, snakeviz...), anything else a JSON of the stages."""
+    try:
+        if path.endswith(".prof"):
+            if PROFILER:
+                PROFILER.disable()
+                PROFILER.dump_stats(path)
+        else:
+            with LOCK:
+                stages = {
+                    name: {"calls": calls, "time": elapsed}
+                    for name, (calls, elapsed) in STAGES.items()
+                }
+            with open(path, "w", encoding="utf8") as f:
+                json.dump({"total": total, "stages": stages}, f, indent=2)
+    except OSError as err:
+        log.LogWarning(f"Failed to write the timing dump ({err})")
+        return
+    log.LogInfo(f"Timing saved in {path}")
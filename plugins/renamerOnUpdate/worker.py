@@ -0,0 +1,201 @@
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import log
+
+# A hook hands its scene to the worker through a local socket. Every message is
+# one line of JSON. The worker takes the job (an empty line of JSON), the hook
+# confirms it's still waiting (same line), then the worker answers with the plugin
+# output and the log lines written while renaming, the hook prints them back so
+# they reach Stash.
+# With a quiet window, the hook of an update waits for it to end. If the scene is
+# updated again meanwhile (identify, scrape...), the first hook is answered at
+# once and the scene is renamed for the last one.
+
+HOST = "127.0.0.1"
+# seconds for a hook to have its job taken by the worker
+TIMEOUT = 5
+# seconds for the worker to read a job, the hooks send it as soon as connected
+READ_TIMEOUT = 1
+
+
+def send(port: int, job: dict):
+    """Give a job to the running worker, returns its result.
+
+    None if no worker is running (one can be started), False if the worker didn't
+    take the job in time. In both cases the hook renames the scene itself.
+    """
+    try:
+        sock = socket.create_connection((HOST, port), timeout=1)
+    except ConnectionRefusedError:
+        return None
+    except OSError:
+        return False
+    with sock:
+        try:
+            # a busy or stuck worker (or another program on the port) doesn't
+            # take the job in time.
+            sock.settimeout(TIMEOUT)
+            sock.sendall(json.dumps(job).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                if not f.readline():
+                    return False
+                # still waiting, the worker can run the job
+                sock.sendall(b"{}\n")
+                # the rename can take a while
+                sock.settimeout(None)
+                line = f.readline()
+        except (OSError, ValueError):
+            return False
+    if not line:
+        # the worker stopped before answering
+        return None
+    result = json.loads(line)
+    sys.stderr.write(result.get("log", ""))
+    sys.stderr.flush()
+    if result.get("restart"):
+        return None
+    return result
+
+
+def spawn(script: str, fragment: dict):
+    """Start a worker in the background, detached from the current hook."""
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        kwargs["start_new_session"] = True
+    # stdout/stderr must not be inherited, Stash waits for them to be closed.
+    proc = subprocess.Popen(
+        [sys.executable, script],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(script),
+        **kwargs,
+    )
+    proc.stdin.write(json.dumps(fragment).encode())
+    proc.stdin.close()
+
+
+def listen(port: int):
+    """The server socket of the worker, None if another worker is already listening."""
+    try:
+        return socket.create_server((HOST, port))
+    except OSError:
+        return None
+
+
+def serve(server, handler, idle_timeout: float, token: str, quiet_window: float = 0):
+    """Run `handler` for every job received, until nothing comes for `idle_timeout`s.
+
+    Only the jobs carrying `token` are taken, it's saved where the hooks can read
+    it, not every program able to reach the port.
+    The handler returns the dict sent back to the hook. A `restart` key stops the
+    worker after answering, the hook then does the job itself.
+    With a `quiet_window`, a job waits that long before running. A new job for
+    the same scene replaces it and waits again, so a scene updated several times
+    in a row is only renamed once, after its last update.
+    """
+    # scene_id: [deadline, connection, job], answered when the deadline is past
+    pending = {}
+    with server:
+        while True:
+            if pending:
+                # the jobs whose window is over run before accepting the next ones,
+                # a rename can take longer than the window of the other scenes.
+                now = time.monotonic()
+                due = [k for k, p in pending.items() if p[0] <= now]
+                if due:
+                    for scene_id in due:
+                        _, conn, job = pending.pop(scene_id)
+                        if run(conn, handler, job).get("restart"):
+                            # the waiting hooks will rename their scene themselves
+                            for _, waiting, _ in pending.values():
+                                answer(waiting, {"restart": True, "log": ""})
+                            return
+                    continue
+                server.settimeout(min(p[0] for p in pending.values()) - now)
+            else:
+                server.settimeout(idle_timeout)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if not pending:
+                    return
+                continue
+            job = receive(conn, token)
+            if job is None:
+                continue
+            if quiet_window <= 0:
+                if run(conn, handler, job).get("restart"):
+                    return
+                continue
+            replaced = pending.pop(job["scene_id"], None)
+            if replaced:
+                _, lines = captured(
+                    log.LogDebug,
+                    f"[{job['scene_id']}] Updated again, renamed after the last update",
+                )
+                answer(
+                    replaced[1], {"output": "Successful!", "error": None, "log": lines}
+                )
+            pending[job["scene_id"]] = [time.monotonic() + quiet_window, conn, job]
+
+
+def receive(conn, token: str):
+    """Read the job sent on `conn` and tell the hook it's taken, None if it isn't."""
+    # a client that connects and sends nothing must not block the worker
+    conn.settimeout(READ_TIMEOUT)
+    try:
+        with conn.makefile("rb") as f:
+            job = json.loads(f.readline())
+            if not isinstance(job, dict) or job.get("token") != token:
+                raise ValueError("invalid job")
+            # The hook gives up after TIMEOUT and renames the scene itself, its
+            # job can still be waiting in the backlog. The job only runs if the
+            # hook confirms it's still waiting for it.
+            conn.sendall(b"{}\n")
+            if not f.readline():
+                raise ValueError("job withdrawn")
+    except (OSError, ValueError):
+        conn.close()
+        return None
+    return job
+
+
+def captured(fn, *args):
+    """Call `fn`, returns what it returns and the log lines it wrote.
+
+    log.py writes to sys.stderr, the lines of a job are sent back to its hook.
+    """
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        result = fn(*args)
+    finally:
+        lines = sys.stderr.getvalue()
+        sys.stderr = stderr
+    return result, lines
+
+
+def run(conn, handler, job: dict) -> dict:
+    result, lines = captured(handler, job)
+    result["log"] = lines
+    answer(conn, result)
+    return result
+
+
+def answer(conn, result: dict):
+    with conn:
+        try:
+            conn.sendall(json.dumps(result).encode() + b"\n")
+        except OSError:
+            pass
@@ -15,6 +15,8 @@ DRY_RUN = False
 FEMALE_ONLY = False
 # Print debug message
 DEBUG_MODE = True
+# Scenes read from the database at once
+FETCH_SIZE = 1000
 
 
 def logPrint(q):
@@ -55,40 +57,42 @@ def get_SceneID_fromTags(id):
     return list
 
 
-def get_Perf_fromSceneID(id_scene):
-    perf_list = ""
-    cursor.execute(
-        "SELECT performer_id from performers_scenes WHERE scene_id=?;", [id_scene]
+def get_SceneInfo(optionnal_query=""):
+    # One query for all the scenes (studio, performers) instead of a few per scene,
+    # the rows are read by batches of FETCH_SIZE.
+    scene_cursor = sqliteConnection.cursor()
+    scene_cursor.execute(
+        """
+        SELECT scenes.id, scenes.path, scenes.title, scenes.date, scenes.height,
+            studios.name, scene_performers.performer_count, scene_performers.names
+        FROM (SELECT id,path,title,date,studio_id,height from scenes {}) AS scenes
+        LEFT JOIN studios ON studios.id = scenes.studio_id
+        LEFT JOIN (
+            SELECT performers_scenes.scene_id,
+                COUNT(*) AS performer_count,
+                GROUP_CONCAT(
+                    CASE WHEN ? = 0 OR performers.gender = 'FEMALE'
+                    THEN performers.name END,
+                    ' '
+                ) AS names
+            FROM (
+                SELECT scene_id, performer_id from performers_scenes
+                ORDER BY scene_id, rowid
+            ) AS performers_scenes
+            LEFT JOIN performers ON performers.id = performers_scenes.performer_id
+            GROUP BY performers_scenes.scene_id
+        ) AS scene_performers ON scene_performers.scene_id = scenes.id
+        ORDER BY scenes.id;
+        """.format(optionnal_query),
+        [FEMALE_ONLY],
     )
-    record = cursor.fetchall()
-    # logPrint("Performer in scene: ", len(record))
-    if len(record) > 3:
-        logPrint("More than 3 performers.")
-    else:
-        perfcount = 0
+    while True:
+        record = scene_cursor.fetchmany(FETCH_SIZE)
+        if not record:
+            break
         for row in record:
-            perf_id = str(row[0])
-            cursor.execute("SELECT name,gender from performers WHERE id=?;", [perf_id])
-            perf = cursor.fetchall()
-            if FEMALE_ONLY == True:
-                # Only take female gender
-                if str(perf[0][1]) == "FEMALE":
-                    perf_list += str(perf[0][0]) + " "
-                    perfcount += 1
-                else:
-                    continue
-            else:
-                perf_list += str(perf[0][0]) + " "
-                perfcount += 1
-    perf_list = perf_list.strip()
-    return perf_list
-
-
-def get_Studio_fromID(id):
-    cursor.execute("SELECT name from studios WHERE id=?;", [id])
-    record = cursor.fetchall()
-    studio_name = str(record[0][0])
-    return studio_name
+            yield row
+    scene_cursor.close()
 
 
 def makeFilename(scene_info, query):
@@ -135,21 +139,16 @@ def makeFilename(scene_info, query):
     return new_filename
 
 
-def edit_db(query_filename, optionnal_query=None):
-    query = "SELECT id,path,title,date,studio_id,height from scenes;"
-    if optionnal_query is not None:
-        query = "SELECT id,path,title,date,studio_id,height from scenes {};".format(
-            optionnal_query
-        )
-    cursor.execute(query)
-    record = cursor.fetchall()
-    if len(record) == 0:
+def edit_db(query_filename, optionnal_query=""):
+    cursor.execute("SELECT COUNT(*) from scenes {};".format(optionnal_query))
+    scene_count = cursor.fetchone()[0]
+    if scene_count == 0:
         logPrint("[Warn] There is no scene to change with this query")
         return
-    logPrint("Scenes numbers: {}".format(len(record)))
+    logPrint("Scenes numbers: {}".format(scene_count))
     progressbar_Index = 0
-    progress = progressbar.ProgressBar(redirect_stdout=True).start(len(record))
-    for row in record:
+    progress = progressbar.ProgressBar(redirect_stdout=True).start(scene_count)
+    for row in get_SceneInfo(optionnal_query):
         progress.update(progressbar_Index + 1)
         progressbar_Index += 1
         scene_ID = str(row[0])
@@ -160,16 +159,16 @@ def edit_db(query_filename, optionnal_query=None):
         file_extension = os.path.splitext(current_path)[1]
         scene_title = str(row[2])
         scene_date = str(row[3])
-        scene_Studio_id = str(row[4])
-        file_height = str(row[5])
+        file_height = str(row[4])
+        studio_name = row[5] or ""
         # By default, title contains extensions.
         scene_title = re.sub(file_extension + "$", "", scene_title)
 
-        performer_name = get_Perf_fromSceneID(scene_ID)
-
-        studio_name = ""
-        if scene_Studio_id and scene_Studio_id != "None":
-            studio_name = get_Studio_fromID(scene_Studio_id)
+        performer_name = ""
+        if row[6] and row[6] > 3:
+            logPrint("More than 3 performers.")
+        elif row[7]:
+            performer_name = row[7].strip()
 
         if file_height == "4320":
             file_height = "8k"